@@ -34,10 +34,13 @@ def _main():
     # create empty dataframe to store results
     channel_distances = pd.DataFrame()
 
+    # writer for the results. The spectrograms are read using the same file handle
+    data_writer = cl.DataWriter()
+
     for spectrogram_group_name in channel_spectrogram_list:
 
-        # reopen the file with pandas HDF
-        data_store_file = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME)
+        # read from the data file using the handle kept by the writer
+        data_store_file = data_writer.store
 
         # Test if dataset is of the spectrogram type
         if H5.EM_SPECTRUM_DATA_GROUP in spectrogram_group_name:
@@ -45,18 +48,19 @@ def _main():
             # get the channel ID
             channel_id = spectrogram_group_name.split(H5.EM_SPECTRUM_DATA_GROUP)[1]
 
-            # get the dataframe
-            channel_traces = data_store_file[H5.CHANNEL_DATA_GROUP+'/'+spectrogram_group_name]
-            frequency_at_peak = channel_traces.idxmax(axis=1).mean()
-
-            number_of_time_samples = channel_traces.shape[0]
+            # get the spectrogram size without reading the traces
+            spectrogram_group = H5.CHANNEL_DATA_GROUP+'/'+spectrogram_group_name
+            number_of_time_samples, number_of_bins = cl.spectrogram_shape(data_store_file, spectrogram_group)
 
             if number_of_time_samples > cn.MINIMUM_NUMBER_SAMPLES_FOR_INNER_ANALYSIS:
 
                 # reduce the number of traces to make computation viable
-                if number_of_time_samples*channel_traces.shape[1] > cn.MAXIMUM_NUMBER_DATAPOINTS_FOR_INNER_ANALYSIS:
-                    number_of_time_samples = int(round(cn.MAXIMUM_NUMBER_DATAPOINTS_FOR_INNER_ANALYSIS/channel_traces.shape[1],0))
-                    channel_traces = channel_traces.iloc[0:number_of_time_samples, :]
+                if number_of_time_samples*number_of_bins > cn.MAXIMUM_NUMBER_DATAPOINTS_FOR_INNER_ANALYSIS:
+                    number_of_time_samples = int(round(cn.MAXIMUM_NUMBER_DATAPOINTS_FOR_INNER_ANALYSIS/number_of_bins,0))
+
+                # get the dataframe, reading only the traces to be analysed
+                channel_traces = cl.read_spectrogram(data_store_file, spectrogram_group, maximum_number_of_traces=number_of_time_samples)
+                frequency_at_peak = channel_traces.idxmax(axis=1).mean()
 
                 figure_name = "Spectrogram channel {}".format(channel_id)
                 plt.figure(figure_name)
@@ -158,15 +162,11 @@ def _main():
 
                 channel_distances = channel_distances.append(channel_distance_descriptor)
 
-                #close file used to read the data
-                data_store_file.close()
-
-                # store the dataframe with the data. Since this is a slow process, it is stored each update for safe interruption
-                output_file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME
-                file_data_store = pd.HDFStore(output_file_name)
+                # store the dataframe with the data. Since this is a slow process, it is stored often for safe interruption.
+                # Each channel counts as one update and the table is written every OUTPUT_BATCH_SIZE channels, with the last batch written on exit or termination.
+                # If the process is killed, only the channels processed after the last batch are lost
                 output_group_name = H5.CHANNEL_DATA_GROUP+"/"+cn.CHANNEL_DISTANCES_DATA_GROUP
-                file_data_store[output_group_name] = channel_distances
-                file_data_store.close()
+                data_writer.write_dataframe(output_group_name, channel_distances)
 
                 cl.log_message("Processed channel {}. Inner distance of {}".format(channel_id, channel_distances.loc[channel_id, cn.INNER_DISTANCE_MAX]))
 
@@ -174,18 +174,14 @@ def _main():
 
             else:
 
-                #close file used to read the data
-                data_store_file.close()
-
                 channel_distances.loc[channel_id,:] = np.NaN
 
-                output_file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME
-                file_data_store = pd.HDFStore(output_file_name)
                 output_group_name = H5.CHANNEL_DATA_GROUP+"/"+cn.CHANNEL_DISTANCES_DATA_GROUP
-                file_data_store[output_group_name] = channel_distances
-                file_data_store.close()
+                data_writer.write_dataframe(output_group_name, channel_distances)
 
                 cl.log_message("Processed channel {}. Too few traces to evaluate inner distance. # traces: ".format(channel_id, number_of_time_samples))
 
+    data_writer.close()
+
 if __name__ == '__main__':
     _main()
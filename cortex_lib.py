@@ -1,9 +1,18 @@
 #!/usr/bin/python3
 
 import math as m
+import os
+import atexit
+import signal
+import hashlib
+import fcntl
+from collections import OrderedDict
+from multiprocessing import Pool
 from datetime import datetime
 import numpy as np
 import pandas as pd
+import h5py
+import tables
 import matplotlib.pyplot as plt
 
 from tkinter import *
@@ -12,6 +21,7 @@ import pandas as pd
 
 
 import h5_spectrum as H5
+import cortex_names as cn
 
 STAT_NORMAL = np.dtype([(H5.MEAN_MEMBER, np.float64),
                         (H5.STANDARD_DEVIATION_MEMBER, np.float64),
@@ -112,11 +122,873 @@ class Normal:
     def print(self, reference):
         print(reference+"(\u03BC:{}, \u03C3:{}, #:{}, \u03A3:{}, SS:{})".format(self.mean_value, self.std_value, self.count, self.sum, self.sum_squares))
 
+# read all attributes of a HDF5 object in a single pass. Attributes stored as single element arrays are returned as scalars
+def read_attributes(h5_object) -> dict:
+    attributes = {}
+    for attribute_name, attribute_value in h5_object.attrs.items():
+        if isinstance(attribute_value, np.ndarray) and attribute_value.shape == (1,):
+            attribute_value = attribute_value[0]
+        attributes[attribute_name] = attribute_value
+
+    return attributes
+
+# return the value of the first logbook entry of the designated type, or None if there is no such entry.
+# The entry type member of the whole logbook is read in one call and filtered with a mask, only the matching entry value is decoded
+def logbook_entry(logbook_dataset, entry_type):
+    entry_types = logbook_dataset.fields(H5.ENTRY_TYPE_MEMBER)[:].astype(bytes)
+    matching_entries = np.flatnonzero(entry_types == entry_type.encode("ascii"))
+
+    if matching_entries.size == 0:
+        return None
+
+    entry_value = logbook_dataset.fields(H5.ENTRY_VALUE_MEMBER)[matching_entries[0]]
+    if isinstance(entry_value, bytes):
+        entry_value = entry_value.decode("ascii")
+
+    return entry_value
+
+# Datasets required within each group class of the Spectrum monitoring digital exchange format, with the expected rank and numpy dtype kinds
+REQUIRED_DATASETS = {H5.SPECTROGRAM_CLASS: {H5.SPECTROGRAM_DATASET: (H5.RANK_2D, 'iuf'),
+                                            H5.FREQUENCY_DATASET: (H5.RANK_1D, 'iuf'),
+                                            H5.TIMESTAMP_COARSE_DATASET: (H5.RANK_1D, 'iu'),
+                                            H5.TIMESTAMP_FINE_DATASET: (H5.RANK_1D, 'iu')},
+                     H5.LEVEL_PROFILE_CLASS: {H5.LEVEL_PROFILE_DATASET: (H5.RANK_2D, 'iuf'),
+                                              H5.FREQUENCY_DATASET: (H5.RANK_1D, 'iuf'),
+                                              H5.LEVEL_DATASET: (H5.RANK_1D, 'iuf')},
+                     H5.ACTIVITY_PROFILE_CLASS: {}}
+
+# Attributes required within each group class, as used by the indexing and merging scripts
+REQUIRED_GROUP_ATTRIBUTES = {H5.SPECTROGRAM_CLASS: [],
+                             H5.LEVEL_PROFILE_CLASS: [],
+                             H5.ACTIVITY_PROFILE_CLASS: [H5.AVERAGE_CHANNEL_SAMPLE_RATE,
+                                                         H5.CHANNEL_EDGE_INITIAL_FREQUENCY,
+                                                         H5.CHANNEL_CORE_INITIAL_FREQUENCY,
+                                                         H5.CHANNEL_CORE_FINAL_FREQUENCY,
+                                                         H5.CHANNEL_EDGE_FINAL_FREQUENCY]}
+
+# convert a string attribute value to text, independent of it being stored as bytes or str
+def _attribute_text(attribute_value) -> str:
+    if isinstance(attribute_value, bytes):
+        return attribute_value.decode("ascii", errors="replace")
+    return str(attribute_value)
+
+# test a single group against the rules for its class. Return an error message or None if the group is valid
+def _validate_group(group_path, group) -> str:
+    group_attributes = read_attributes(group)
+
+    if H5.CLASS_ATTRIBUTE not in group_attributes:
+        return "Group {} has no {} attribute".format(group_path, H5.CLASS_ATTRIBUTE)
+
+    group_class_text = _attribute_text(group_attributes[H5.CLASS_ATTRIBUTE])
+    group_class = next((one_class for one_class in REQUIRED_DATASETS if one_class in group_class_text), None)
+    if group_class is None:
+        return "Group {} has unknown class {}".format(group_path, group_class_text)
+
+    for attribute_name in REQUIRED_GROUP_ATTRIBUTES[group_class]:
+        if attribute_name not in group_attributes:
+            return "Group {} is missing attribute {}".format(group_path, attribute_name)
+
+    for dataset_name, (rank, dtype_kinds) in REQUIRED_DATASETS[group_class].items():
+        if dataset_name not in group:
+            return "Group {} is missing dataset {}".format(group_path, dataset_name)
+        dataset = group[dataset_name]
+        if len(dataset.shape) != rank:
+            return "Dataset {}/{} has rank {}, expected {}".format(group_path, dataset_name, len(dataset.shape), rank)
+        if dataset.dtype.kind not in dtype_kinds:
+            return "Dataset {}/{} has type {}".format(group_path, dataset_name, dataset.dtype)
+
+    # the spectrogram shape should match the time and frequency axis
+    if group_class == H5.SPECTROGRAM_CLASS:
+        expected_shape = (group[H5.TIMESTAMP_COARSE_DATASET].shape[0], group[H5.FREQUENCY_DATASET].shape[0])
+        if group[H5.SPECTROGRAM_DATASET].shape != expected_shape:
+            return "Dataset {}/{} shape does not match the time and frequency axis".format(group_path, H5.SPECTROGRAM_DATASET)
+
+    return None
+
+# test if an open file follows the Spectrum monitoring digital exchange format. Return an error message or None if the file is valid
+def _validate_file_object(file_object) -> str:
+    file_attributes = read_attributes(file_object)
+
+    if _attribute_text(file_attributes.get(H5.STANDARD_ATTRIBUTE, "")) != H5.STANDARD:
+        return "File does not declare the {} standard".format(H5.STANDARD)
+
+    if _attribute_text(file_attributes.get(H5.CLASS_ATTRIBUTE, "")) != H5.FILETYPE_CLASS:
+        return "File class is not {}".format(H5.FILETYPE_CLASS)
+
+    if H5.SITE_GEOLOCATION_DATASET in file_object:
+        site_attributes = read_attributes(file_object[H5.SITE_GEOLOCATION_DATASET])
+        for attribute_name in [H5.LATITUDE_STATISTICS_ATTRIBUTE, H5.LONGITUDE_STATISTICS_ATTRIBUTE]:
+            if attribute_name not in site_attributes:
+                return "Dataset {} is missing attribute {}".format(H5.SITE_GEOLOCATION_DATASET, attribute_name)
+
+    if H5.LOGBOOK_DATASET in file_object:
+        logbook_fields = file_object[H5.LOGBOOK_DATASET].dtype.names or ()
+        for member_name in [H5.ENTRY_TYPE_MEMBER, H5.ENTRY_VALUE_MEMBER]:
+            if member_name not in logbook_fields:
+                return "Dataset {} is missing member {}".format(H5.LOGBOOK_DATASET, member_name)
+
+    for group_name in [H5.FREQUENCY_SWEEP_DATA_GROUP, H5.NOISE_DATA_GROUP, H5.CHANNEL_DATA_GROUP]:
+        if group_name in file_object:
+            for sub_group_name, sub_group in file_object[group_name].items():
+                error_message = _validate_group(group_name+"/"+sub_group_name, sub_group)
+                if error_message is not None:
+                    return error_message
+
+    return None
+
+# test if a file follows the Spectrum monitoring digital exchange format. Return a tuple with the result and the error message
+def validate_file(file_name):
+    try:
+        file_object = h5py.File(file_name, 'r')
+    except OSError as error:
+        return False, "File can't be read as HDF5: {}".format(error)
+
+    try:
+        error_message = _validate_file_object(file_object)
+    except (KeyError, ValueError, OSError) as error:
+        error_message = "File structure can't be read: {}".format(error)
+    finally:
+        file_object.close()
+
+    if error_message is None:
+        return True, ""
+
+    return False, error_message
+
+# test if a file follows the Spectrum monitoring digital exchange format.
+# Return a tuple with the file size and modification time when tested, the result and the error message, or None if the file can't be accessed
+def validate_file_status(file_name):
+    try:
+        file_status = os.stat(file_name)
+    except OSError:
+        return None
+
+    return (file_status.st_size, file_status.st_mtime)+validate_file(file_name)
+
+# Validate files against the exchange format, keeping the results on a sidecar store.
+# Results are reused while the file size and modification time are unchanged, such as that later runs only validate new or modified files.
+# The store is shared by the inbox watchdog and the batch scripts, thus it is read and written holding the lock of its sidecar lock file,
+# and new results are appended to the stored table, where the last row of each file prevails, instead of rewriting it
+class FileValidator:
+
+    # columns of the stored table, in the order of the cached results
+    COLUMNS = [cn.FILENAME_ATTRIBUTE,
+               cn.FILE_SIZE,
+               cn.FILE_MODIFICATION_TIME,
+               cn.FILE_IS_VALID,
+               cn.FILE_VALIDATION_MESSAGE]
+
+    def __init__(self, cache_file_name=cn.FOLDER_TO_STORE_FILES+'/'+cn.VALIDATION_CACHE_FILENAME):
+        self.cache_file_name = cache_file_name
+        self.cache = {}
+        self.new_results = {}
+
+        if os.path.isfile(cache_file_name):
+            cache_store = IndexStore(cache_file_name, mode='r')
+            if cn.FILE_VALIDATION in cache_store:
+                self._load(cache_store[cn.FILE_VALIDATION])
+            cache_store.close()
+
+    def _load(self, cache_table: pd.DataFrame):
+        for file_name, file_size, modification_time, is_valid, error_message in cache_table[self.COLUMNS].itertuples(index=False):
+            self.cache[file_name] = (file_size, modification_time, is_valid, error_message)
+
+    # return the cached result if the file was not modified since it was tested, None otherwise
+    def cached_result(self, file_name):
+        try:
+            file_status = os.stat(file_name)
+        except OSError:
+            return None
+
+        cached_result = self.cache.get(file_name)
+        if cached_result is not None and cached_result[0] == file_status.st_size and cached_result[1] == file_status.st_mtime:
+            return cached_result
+
+        return None
+
+    # return True if the file follows the standard. Invalid files are reported on the log
+    def is_valid(self, file_name) -> bool:
+        cached_result = self.cached_result(file_name)
+        if cached_result is not None:
+            return cached_result[2]
+
+        return self.add_result(file_name, validate_file_status(file_name))
+
+    # keep a result returned by validate_file_status, e.g. from a worker process, and return True if the file follows the standard. Invalid files are reported on the log
+    def add_result(self, file_name, validation_result) -> bool:
+        if validation_result is None:
+            log_message("File {} can't be accessed and will be ignored".format(file_name))
+            return False
+
+        file_size, modification_time, is_valid, error_message = validation_result
+        validation_result = (file_size, modification_time, bool(is_valid), error_message[:cn.INDEX_MESSAGE_SIZE])
+        self.cache[file_name] = validation_result
+        self.new_results[file_name] = validation_result
+
+        if not is_valid:
+            log_message("File {} does not follow the standard and will be ignored. {}".format(file_name, error_message))
+
+        return is_valid
+
+    # store the new results, if any
+    def close(self):
+        if not self.new_results:
+            return
+
+        new_table = pd.DataFrame.from_records([[file_name]+list(result) for file_name, result in self.new_results.items()], columns=self.COLUMNS)
+        new_table = new_table.astype({cn.FILE_SIZE: 'int64', cn.FILE_MODIFICATION_TIME: 'float64', cn.FILE_IS_VALID: 'bool'})
+
+        cache_store = IndexStore(self.cache_file_name)
+        try:
+            if cn.FILE_VALIDATION in cache_store and cache_store.get_storer(cn.FILE_VALIDATION).is_table:
+                append_index_table(cache_store, cn.FILE_VALIDATION, new_table)
+            else:
+                # the table is created or, if stored in fixed format by a previous version, converted keeping the results stored by other process
+                if cn.FILE_VALIDATION in cache_store:
+                    stored_table = cache_store[cn.FILE_VALIDATION]
+                    new_table = pd.concat([stored_table[~stored_table[cn.FILENAME_ATTRIBUTE].isin(self.new_results)], new_table], ignore_index=True)
+                    new_table[cn.FILE_VALIDATION_MESSAGE] = new_table[cn.FILE_VALIDATION_MESSAGE].str.slice(0, cn.INDEX_MESSAGE_SIZE)
+                store_index_table(cache_store, cn.FILE_VALIDATION, new_table)
+        finally:
+            cache_store.close()
+
+        self.new_results.clear()
+
+# Store for the index file that holds a lock on a sidecar file while open, such as that the inbox watchdog and the batch scripts don't write the index at the same time.
+# Also used for other files shared by them, such as the validation cache.
+# Stores opened for reading share the lock and stores opened for writing hold it exclusively. The lock is released when the store is closed
+class IndexStore(pd.HDFStore):
+
+    def __init__(self, file_name=None, mode='a'):
+        if file_name is None:
+            file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME
+
+        # wait for the lock before opening the file
+        self.lock_file = open(file_name+cn.LOCK_FILE_EXTENSION, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+
+        try:
+            super().__init__(file_name, mode=mode)
+        except BaseException:
+            self._release_lock()
+            raise
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release_lock()
+
+    def _release_lock(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+# Keep source files open for reading while they are used, such as that each file is opened once even when accessed multiple times.
+# The least recently used file is closed when the number of open files reaches the limit
+class OpenFileCache:
+
+    def __init__(self, maximum_open_files=cn.OPEN_FILES_CACHE_SIZE):
+        self.maximum_open_files = max(1, maximum_open_files)
+        self.open_files = OrderedDict()
+
+    # return the h5py file object for the designated file, opening it if needed
+    def get(self, file_name) -> h5py.File:
+        file_object = self.open_files.get(file_name)
+
+        if file_object is not None:
+            self.open_files.move_to_end(file_name)
+            return file_object
+
+        if len(self.open_files) >= self.maximum_open_files:
+            _, least_recent_file_object = self.open_files.popitem(last=False)
+            least_recent_file_object.close()
+
+        file_object = h5py.File(file_name, 'r')
+        self.open_files[file_name] = file_object
+
+        return file_object
+
+    # close all files
+    def close(self):
+        for file_object in self.open_files.values():
+            file_object.close()
+        self.open_files.clear()
+
+# Accumulate level profiles, histograms of the number of traces at each level and frequency, from multiple files into a single profile.
+# Frequencies are snapped to a grid with the frequency resolution and levels to a grid with the level step of the first profile added.
+# Counts are kept on an integer array with a row for each level on the grid and a column for each frequency found.
+# Rows and columns are preallocated with spare room, such as that the array is only reallocated a few times, when a profile extends beyond the spare levels or includes more new frequencies than the spare columns
+class ProfileAccumulator:
+
+    def __init__(self, frequency_resolution=cn.FREQUENCY_RESOLUTION, level_step=None):
+        self.frequency_resolution = frequency_resolution
+        self.level_step = level_step
+        self.number_of_traces = 0
+
+        # frequency of each column, in the order the columns were added, and level of the first row, as integer positions on the grid
+        self.frequency = np.empty(0, dtype=np.int64)
+        self.level_origin = 0
+        self.level_minimum = None
+        self.level_maximum = None
+
+        # frequencies sorted in increasing order and the corresponding columns, used to locate the column of each frequency
+        self.sorted_frequency = np.empty(0, dtype=np.int64)
+        self.sorted_columns = np.empty(0, dtype=np.int64)
+
+        # columns beyond the number of frequencies are spare, such as that new frequencies are added without reallocating the array
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+
+    # number of levels and frequencies on the accumulated profile
+    @property
+    def shape(self):
+        if self.level_minimum is None:
+            return 0, len(self.frequency)
+        return self.level_maximum - self.level_minimum + 1, len(self.frequency)
+
+    # add a level profile with levels on the rows and frequencies on the columns.
+    # level_step is the step between levels on the profile, as given by the level step attribute, computed from the level axis if not available
+    def add(self, profile, frequency, level, level_step=None, number_of_traces=0):
+        profile = np.asarray(profile).astype(np.int64, copy=False)
+        frequency = np.asarray(frequency, dtype=np.float64)
+        level = np.asarray(level, dtype=np.float64)
+
+        if self.level_step is None:
+            if level_step is None or not level_step > 0:
+                level_step = np.median(np.abs(np.diff(level))) if len(level) > 1 else 1.0
+            self.level_step = float(level_step)
+
+        frequency_position = np.rint(frequency/self.frequency_resolution).astype(np.int64)
+        level_position = np.rint(level/self.level_step).astype(np.int64)
+
+        columns = self._columns(frequency_position)
+        rows = self._rows(level_position)
+
+        # positions are unique unless the profile uses a finer grid than the accumulator, in which case counts on the same position are added
+        if len(np.unique(rows)) == len(rows) and len(np.unique(columns)) == len(columns):
+            self.counts[np.ix_(rows, columns)] += profile
+        else:
+            np.add.at(self.counts, (rows[:, np.newaxis], columns[np.newaxis, :]), profile)
+
+        self.number_of_traces += number_of_traces
+
+    # return the column for each frequency position, adding columns for new frequencies.
+    # Columns are added after the existing ones, reallocating the array with twice the columns when there is no spare column left
+    def _columns(self, frequency_position: np.ndarray) -> np.ndarray:
+        position = np.searchsorted(self.sorted_frequency, frequency_position)
+        is_new = position == len(self.sorted_frequency)
+        is_new[~is_new] = self.sorted_frequency[position[~is_new]] != frequency_position[~is_new]
+
+        if is_new.any():
+            new_frequency = np.unique(frequency_position[is_new])
+            number_of_columns = len(self.frequency)
+
+            if number_of_columns+len(new_frequency) > self.counts.shape[1]:
+                counts = np.zeros((self.counts.shape[0], max(2*self.counts.shape[1], number_of_columns+len(new_frequency))), dtype=np.int64)
+                counts[:, :number_of_columns] = self.counts[:, :number_of_columns]
+                self.counts = counts
+
+            sorted_position = np.searchsorted(self.sorted_frequency, new_frequency)
+            self.sorted_frequency = np.insert(self.sorted_frequency, sorted_position, new_frequency)
+            self.sorted_columns = np.insert(self.sorted_columns, sorted_position, np.arange(number_of_columns, number_of_columns+len(new_frequency)))
+            self.frequency = np.append(self.frequency, new_frequency)
+
+            position = np.searchsorted(self.sorted_frequency, frequency_position)
+
+        return self.sorted_columns[position]
+
+    # return the row for each level position, reallocating the array with spare rows if the levels are beyond the current rows
+    def _rows(self, level_position: np.ndarray) -> np.ndarray:
+        level_minimum = int(level_position.min())
+        level_maximum = int(level_position.max())
+
+        if self.level_minimum is None:
+            self.level_minimum = level_minimum
+            self.level_maximum = level_maximum
+        else:
+            self.level_minimum = min(self.level_minimum, level_minimum)
+            self.level_maximum = max(self.level_maximum, level_maximum)
+
+        number_of_rows = self.counts.shape[0]
+        if self.level_minimum < self.level_origin or self.level_maximum >= self.level_origin + number_of_rows or number_of_rows == 0:
+            # keep room for the same number of levels on each side
+            span = self.level_maximum - self.level_minimum + 1
+            level_origin = self.level_minimum - span
+            counts = np.zeros((3*span, self.counts.shape[1]), dtype=np.int64)
+
+            if number_of_rows > 0:
+                offset = self.level_origin - level_origin
+                counts[offset:offset+number_of_rows, :] = self.counts
+
+            self.level_origin = level_origin
+            self.counts = counts
+
+        return level_position - self.level_origin
+
+    # return the accumulated profile as a dataframe, with the levels as index and frequencies as columns, both in increasing order
+    def profile(self) -> pd.DataFrame:
+        if self.level_minimum is None:
+            return pd.DataFrame()
+
+        first_row = self.level_minimum - self.level_origin
+        last_row = self.level_maximum - self.level_origin
+
+        return pd.DataFrame(self.counts[first_row:last_row+1, self.sorted_columns],
+                            index=np.arange(self.level_minimum, self.level_maximum+1)*self.level_step,
+                            columns=self.sorted_frequency*self.frequency_resolution)
+
+# Write the results of the processing scripts into the data file, keeping a single handle open for the whole run.
+# Dataframes, arrays and attributes are buffered and written in batches, with the file flushed once for each batch.
+# A write to a path already on the buffer replaces it, but still counts as an update, such as that a table updated after each step is written once every batch_size steps.
+# The buffer is written when the writer is closed, when the program exits or when it is terminated
+class DataWriter:
+
+    def __init__(self, file_name=cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME, batch_size=cn.OUTPUT_BATCH_SIZE):
+        # store used for writing. Data written on previous batches can also be read from it
+        self.store = pd.HDFStore(file_name)
+        self.batch_size = max(1, batch_size)
+        self.datasets = OrderedDict()
+        self.attributes = OrderedDict()
+        self.number_of_updates = 0
+
+        # only the process that opened the file writes to it. Process forked from it, such as pool workers, must not flush the inherited buffer
+        self.owner_process = os.getpid()
+
+        atexit.register(self.close)
+
+        # signal handlers can only be set from the main thread. The previous handler is called after the buffer is written and restored when the writer is closed
+        self.previous_sigterm_handler = None
+        try:
+            self.previous_sigterm_handler = signal.signal(signal.SIGTERM, self._terminate)
+        except ValueError:
+            pass
+
+    # PyTables file under the store, used for the nodes that are not handled by pandas
+    @property
+    def tables_file(self) -> tables.File:
+        return self.store._handle
+
+    # write a dataframe on the designated path, replacing any existing data
+    def write_dataframe(self, path, dataframe: pd.DataFrame):
+        self.datasets[path] = dataframe
+        self._commit_if_full()
+
+    # write an array as a dataset on the designated path, replacing any existing data
+    def write_array(self, path, array):
+        self.datasets[path] = np.asarray(array)
+        self._commit_if_full()
+
+    # create a dataset on the designated path that can be extended along the first dimension, replacing any existing data.
+    # Each row has the designated shape and the dataset is chunked every chunk_rows rows.
+    # Rows appended to the returned array are written directly to the file and are not held on the batch buffer
+    def create_extendable_array(self, path, row_shape=(), dtype=np.float32, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS):
+        self.remove(path)
+        row_shape = tuple(row_shape)
+        group_name, dataset_name = ('/'+path.strip('/')).rsplit('/', 1)
+        return self.tables_file.create_earray(group_name or '/', dataset_name,
+                                              atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                                              shape=(0,)+row_shape,
+                                              chunkshape=(chunk_rows,)+row_shape,
+                                              createparents=True)
+
+    # copy the group or dataset at the designated path of another HDF5 file into the same path, replacing any existing data.
+    # Data is copied directly to the file, one buffer at a time. Return False if the path does not exist on the source file
+    def copy_from(self, file_name, path):
+        path = '/'+path.strip('/')
+        self.remove(path)
+
+        with tables.open_file(file_name, mode='r') as source_file:
+            if path not in source_file:
+                return False
+
+            parent_name, node_name = path.rsplit('/', 1)
+            parent_name = parent_name or '/'
+            if parent_name not in self.tables_file:
+                grandparent_name, group_name = parent_name.rsplit('/', 1)
+                self.tables_file.create_group(grandparent_name or '/', group_name, createparents=True)
+
+            source_file.copy_node(path, newparent=self.tables_file.get_node(parent_name), newname=node_name, recursive=True)
+
+        return True
+
+    # remove the group or dataset at the designated path, including any buffered data written to it
+    def remove(self, path):
+        path = '/'+path.strip('/')
+        for buffer in (self.datasets, self.attributes):
+            for buffered_path in [buffered_path for buffered_path in buffer if ('/'+buffered_path.strip('/')+'/').startswith(path+'/')]:
+                del buffer[buffered_path]
+
+        self._remove_node(path)
+
+    def _remove_node(self, path):
+        if path in self.store:
+            self.tables_file.remove_node('/'+path.strip('/'), recursive=True)
+
+    # set attributes, given as a dictionary, on the group or dataset at the designated path
+    def set_attributes(self, path, attributes: dict):
+        self.attributes.setdefault(path, {}).update(attributes)
+        self._commit_if_full()
+
+    def _commit_if_full(self):
+        self.number_of_updates += 1
+        if self.number_of_updates >= self.batch_size:
+            self.commit()
+
+    # write all buffered data and flush the file
+    def commit(self):
+        self.number_of_updates = 0
+        if self.store is None or not (self.datasets or self.attributes):
+            return
+
+        for path, data in self.datasets.items():
+            if isinstance(data, (pd.DataFrame, pd.Series)):
+                self.store.put(path, data)
+            else:
+                self._remove_node(path)
+                group_name, dataset_name = ('/'+path.strip('/')).rsplit('/', 1)
+                self.tables_file.create_array(group_name or '/', dataset_name, obj=data, createparents=True)
+
+        # attributes are set after the datasets, since they may refer to datasets on the same batch
+        for path, attributes in self.attributes.items():
+            node = self.store.get_node(path)
+            for attribute_name, attribute_value in attributes.items():
+                node._v_attrs[attribute_name] = attribute_value
+
+        self.datasets.clear()
+        self.attributes.clear()
+        self.store.flush()
+
+    # write the buffered data and close the file
+    def close(self):
+        if self.store is None or os.getpid() != self.owner_process:
+            return
+
+        self.commit()
+        self.store.close()
+        self.store = None
+
+        atexit.unregister(self.close)
+        self._restore_sigterm_handler()
+
+    # restore the handler replaced by the writer, unless it was replaced again afterwards
+    def _restore_sigterm_handler(self):
+        try:
+            if signal.getsignal(signal.SIGTERM) == self._terminate:
+                signal.signal(signal.SIGTERM, self.previous_sigterm_handler or signal.SIG_DFL)
+        except ValueError:
+            pass
+
+    def _terminate(self, signal_number, frame):
+        log_message("Terminated by signal {}. Writing buffered data".format(signal_number))
+        previous_sigterm_handler = self.previous_sigterm_handler
+        self.close()
+
+        # handlers set before the writer, such as other writers, also get to finish their work
+        if callable(previous_sigterm_handler):
+            previous_sigterm_handler(signal_number, frame)
+        raise SystemExit(128+signal_number)
+
+# positions of the first and after the last values of the sorted array within the closed interval (minimum, maximum). None can be used for an open end
+def _interval_positions(sorted_array, interval):
+    minimum, maximum = interval
+    first_position = 0 if minimum is None else int(np.searchsorted(sorted_array, minimum, side='left'))
+    last_position = len(sorted_array) if maximum is None else int(np.searchsorted(sorted_array, maximum, side='right'))
+    return first_position, max(first_position, last_position)
+
+# return the number of traces and frequency bins of a channel spectrogram stored by merge_channel_spectrogram
+def spectrogram_shape(data_store: pd.HDFStore, group_name):
+    return tuple(data_store.get_node('/'+group_name.strip('/')+'/'+H5.SPECTROGRAM_DATASET).shape)
+
+# positions of the first and after the last traces of a spectrogram within the time range, given as a closed interval (minimum, maximum).
+# The time axis is strictly increasing, thus the chunk with each end is located by a binary search over the time range of the chunks and the trace by a binary search over the chunk
+def _time_range_positions(timestamp_dataset, chunk_rows, chunk_time_range, time_range):
+    minimum_time, maximum_time = time_range
+    number_of_traces = timestamp_dataset.nrows
+
+    first_trace = 0
+    if minimum_time is not None:
+        chunk = int(np.searchsorted(chunk_time_range[:, 1], minimum_time, side='left'))
+        first_trace = min(chunk*chunk_rows, number_of_traces)
+        if chunk < len(chunk_time_range):
+            first_trace += _interval_positions(timestamp_dataset[first_trace:first_trace+chunk_rows], (minimum_time, None))[0]
+
+    last_trace = number_of_traces
+    if maximum_time is not None:
+        chunk = int(np.searchsorted(chunk_time_range[:, 0], maximum_time, side='right'))-1
+        last_trace = 0
+        if chunk >= 0:
+            last_trace = chunk*chunk_rows + _interval_positions(timestamp_dataset[chunk*chunk_rows:(chunk+1)*chunk_rows], (None, maximum_time))[1]
+
+    return first_trace, max(first_trace, last_trace)
+
+# read a channel spectrogram stored by merge_channel_spectrogram into a dataframe, using the time as index and the frequency as columns.
+# Only the traces within the time range and the bins within the frequency range are read. Ranges are given as closed intervals (minimum, maximum), where None can be used for an open end.
+# Both axes are sorted, thus the selected traces and bins are contiguous and are read at once, after locating the ends using the time range of each chunk stored with the spectrogram.
+# If maximum_number_of_traces is given, only the first traces are returned
+def read_spectrogram(data_store: pd.HDFStore, group_name, time_range=(None, None), frequency_range=(None, None), maximum_number_of_traces=None) -> pd.DataFrame:
+    group_name = '/'+group_name.strip('/')
+
+    spectrogram_dataset = data_store.get_node(group_name+'/'+H5.SPECTROGRAM_DATASET)
+    timestamp_dataset = data_store.get_node(group_name+'/'+cn.TIMESTAMP_DATASET)
+    frequency_axis = data_store.get_node(group_name+'/'+H5.FREQUENCY_DATASET).read()
+    chunk_time_range = data_store.get_node(group_name+'/'+cn.TIMESTAMP_CHUNK_RANGE_DATASET).read()
+
+    first_bin, last_bin = _interval_positions(frequency_axis, frequency_range)
+    first_trace, last_trace = _time_range_positions(timestamp_dataset, spectrogram_dataset.chunkshape[0], chunk_time_range, time_range)
+    if maximum_number_of_traces is not None:
+        last_trace = min(last_trace, first_trace+maximum_number_of_traces)
+
+    return pd.DataFrame(spectrogram_dataset[first_trace:last_trace, first_bin:last_bin],
+                        index=timestamp_dataset[first_trace:last_trace],
+                        columns=frequency_axis[first_bin:last_bin])
+
+# read the overview of a channel spectrogram stored by merge_channel_spectrogram into a dataframe, using the most detailed level of the overview pyramid
+# with no more than the designated number of traces and frequency bins. The spectrogram is read at full resolution if it fits and the coarsest level is used if none fits.
+# statistic selects the maximum or the mean level over the traces and bins combined on the level
+def read_spectrogram_overview(data_store: pd.HDFStore, group_name, maximum_number_of_traces, maximum_number_of_bins=None, statistic=cn.OVERVIEW_MAXIMUM_DATASET) -> pd.DataFrame:
+    group_name = '/'+group_name.strip('/')
+    overview_group_name = group_name+'/'+cn.SPECTROGRAM_OVERVIEW_GROUP
+
+    level_number = 0
+    number_of_traces, number_of_bins = spectrogram_shape(data_store, group_name)
+    while number_of_traces > maximum_number_of_traces or (maximum_number_of_bins is not None and number_of_bins > maximum_number_of_bins):
+        if overview_group_name+'/'+str(level_number+1) not in data_store:
+            break
+        level_number += 1
+        number_of_traces, number_of_bins = data_store.get_node(overview_group_name+'/'+str(level_number)+'/'+statistic).shape
+
+    if level_number == 0:
+        return read_spectrogram(data_store, group_name)
+
+    level_name = overview_group_name+'/'+str(level_number)
+    return pd.DataFrame(data_store.get_node(level_name+'/'+statistic).read(),
+                        index=data_store.get_node(level_name+'/'+cn.TIMESTAMP_DATASET).read(),
+                        columns=data_store.get_node(level_name+'/'+H5.FREQUENCY_DATASET).read())
+
+# Data columns stored for each index table. These are indexed on disk and can be used for queries with index_select
+INDEX_DATA_COLUMNS = {cn.FILE_INDEX: [cn.FILENAME_ATTRIBUTE,
+                                      H5.START_TIME_COARSE_ATTRIBUTE,
+                                      H5.STOP_TIME_COARSE_ATTRIBUTE],
+                      cn.CHANNEL_INDEX: [cn.CHANNEL_ID,
+                                         cn.FILENAME_ATTRIBUTE,
+                                         cn.GROUPNAME_ATTRIBUTE,
+                                         H5.START_TIME_COARSE_ATTRIBUTE,
+                                         H5.STOP_TIME_COARSE_ATTRIBUTE,
+                                         H5.CHANNEL_CORE_INITIAL_FREQUENCY,
+                                         H5.CHANNEL_CORE_FINAL_FREQUENCY],
+                      cn.FILE_MANIFEST: [cn.FILENAME_ATTRIBUTE,
+                                         cn.FILE_CONTENT_HASH],
+                      cn.SITE_INDEX: [cn.FILENAME_ATTRIBUTE,
+                                      H5.CRFS_HOSTNAME],
+                      cn.FILE_VALIDATION: [cn.FILENAME_ATTRIBUTE,
+                                           cn.FILE_VALIDATION_MESSAGE]}
+
+# Minimum size reserved for string columns on the index tables, such as to allow later updates with longer values
+INDEX_STRING_SIZE = {cn.FILENAME_ATTRIBUTE: cn.INDEX_FILENAME_SIZE,
+                     cn.GROUPNAME_ATTRIBUTE: cn.INDEX_GROUPNAME_SIZE,
+                     cn.CHANNEL_ID: cn.INDEX_CHANNEL_ID_SIZE,
+                     H5.CRFS_HOSTNAME: cn.INDEX_HOSTNAME_SIZE,
+                     cn.FILE_CONTENT_HASH: cn.INDEX_HASH_SIZE,
+                     cn.FILE_VALIDATION_MESSAGE: cn.INDEX_MESSAGE_SIZE}
+
+# store an index table in the PyTables table format, creating the on disk index for the data columns
+def store_index_table(index_store: pd.HDFStore, table_name, dataframe: pd.DataFrame):
+    data_columns = INDEX_DATA_COLUMNS[table_name]
+    min_itemsize = {column: size for column, size in INDEX_STRING_SIZE.items() if column in data_columns}
+
+    index_store.put(table_name, dataframe, format='table', data_columns=data_columns, min_itemsize=min_itemsize, index=False)
+    index_store.create_table_index(table_name, columns=data_columns, optlevel=9, kind='full')
+
+# append rows to an index table stored with store_index_table. Row labels continue the numbering of the stored rows
+def append_index_table(index_store: pd.HDFStore, table_name, dataframe: pd.DataFrame):
+    data_columns = INDEX_DATA_COLUMNS[table_name]
+    min_itemsize = {column: size for column, size in INDEX_STRING_SIZE.items() if column in data_columns}
+
+    number_of_rows = index_store.get_storer(table_name).nrows
+    dataframe = dataframe.set_axis(pd.RangeIndex(number_of_rows, number_of_rows+len(dataframe.index)), axis='index')
+
+    index_store.append(table_name, dataframe, format='table', data_columns=data_columns, min_itemsize=min_itemsize)
+
+# coordinates of the site index, held as Normal objects, or np.NaN for files without geolocation, and the members of the statistics stored for each one
+SITE_STATISTICS_COLUMNS = [H5.LATITUDE_MEMBER,
+                           H5.LONGITUDE_MEMBER]
+SITE_STATISTICS_MEMBERS = {H5.MEAN_MEMBER: 'mean_value',
+                           H5.STANDARD_DEVIATION_MEMBER: 'std_value',
+                           H5.NUMBER_OF_SAMPLES_MEMBER: 'count',
+                           H5.SUM_MEMBER: 'sum',
+                           H5.SUM_OF_SQUARES_MEMBER: 'sum_squares'}
+
+# name of the column holding a member of the coordinate statistics on the stored site index
+def _site_statistics_column(column, member):
+    return column+" "+member
+
+# convert the site index into a table with one numeric column for each member of the coordinate statistics, such as that it can be stored in table format and appended
+def _site_index_table(site_index: pd.DataFrame) -> pd.DataFrame:
+    site_table = site_index.drop(columns=SITE_STATISTICS_COLUMNS)
+    for column in SITE_STATISTICS_COLUMNS:
+        for member, attribute in SITE_STATISTICS_MEMBERS.items():
+            site_table[_site_statistics_column(column, member)] = np.array([getattr(statistics, attribute) if isinstance(statistics, Normal) else np.NaN
+                                                      for statistics in site_index[column]], dtype='float64')
+
+    return site_table
+
+# store the site index, replacing the existing one
+def store_site_index(index_store: pd.HDFStore, site_index: pd.DataFrame):
+    store_index_table(index_store, cn.SITE_INDEX, _site_index_table(site_index))
+
+# append rows to the site index. Site index stored in fixed format by a previous version is converted
+def append_site_index(index_store: pd.HDFStore, site_index: pd.DataFrame):
+    if not index_store.get_storer(cn.SITE_INDEX).is_table:
+        store_site_index(index_store, pd.concat([read_site_index(index_store), site_index], ignore_index=True))
+    elif len(site_index.index) > 0:
+        append_index_table(index_store, cn.SITE_INDEX, _site_index_table(site_index))
+
+# read the site index, with the coordinates as Normal objects, or np.NaN for files without geolocation
+def read_site_index(index_store: pd.HDFStore) -> pd.DataFrame:
+    site_table = index_store[cn.SITE_INDEX]
+    if not index_store.get_storer(cn.SITE_INDEX).is_table:
+        return site_table
+
+    site_index = pd.DataFrame(index=site_table.index)
+    for column in SITE_STATISTICS_COLUMNS:
+        member_values = {member: site_table[_site_statistics_column(column, member)].to_numpy() for member in SITE_STATISTICS_MEMBERS}
+        column_statistics = []
+        for row in range(len(site_table.index)):
+            if np.isnan(member_values[H5.NUMBER_OF_SAMPLES_MEMBER][row]):
+                column_statistics.append(np.NaN)
+            else:
+                statistics = Normal()
+                statistics.np_set({member: values[row] for member, values in member_values.items()})
+                statistics.count = int(statistics.count)
+                column_statistics.append(statistics)
+        site_index[column] = pd.Series(column_statistics, index=site_table.index, dtype=object)
+
+    statistics_columns = [_site_statistics_column(column, member) for column in SITE_STATISTICS_COLUMNS for member in SITE_STATISTICS_MEMBERS]
+    for column in site_table.columns.difference(statistics_columns, sort=False):
+        site_index[column] = site_table[column]
+
+    return site_index
+
+# sort the file index by timestamp, as expected by the data processing scripts
+def sort_file_index(file_index: pd.DataFrame):
+    file_index.sort_values(by=[H5.START_TIME_COARSE_ATTRIBUTE], ascending=[True], inplace=True)
+    file_index.reset_index(inplace=True, drop = True)
+
+# sort the channel index by core initial frequency and timestamp, as expected by the data processing scripts
+def sort_channel_index(channel_index: pd.DataFrame):
+    channel_index.sort_values(by=[H5.CHANNEL_CORE_INITIAL_FREQUENCY, H5.START_TIME_COARSE_ATTRIBUTE], ascending=[True, True], inplace=True)
+    channel_index.reset_index(inplace=True, drop = True)
+
+# locate the rows of an index table stored with store_index_table that match the condition, returning their coordinates on the table.
+# where is a dictionary with the data column name as key and as value either a single value, selecting rows where the column is equal to it,
+# or a tuple (minimum, maximum), selecting rows where the column is within the closed interval. None can be used for an open end on the interval.
+# Column names include spaces and can't be used on pandas query strings, thus the condition is evaluated by PyTables using the on disk index
+def index_coordinates(index_store: pd.HDFStore, table_name, where) -> np.ndarray:
+    table = index_store.get_storer(table_name).table
+
+    # build the condition using placeholder variable names for the columns and values
+    conditions = []
+    condition_variables = {}
+    for column_number, (column, value) in enumerate(where.items()):
+        column_variable = "c{}".format(column_number)
+        condition_variables[column_variable] = table.colinstances[column]
+
+        if isinstance(value, tuple):
+            minimum, maximum = value
+            if minimum is not None:
+                condition_variables[column_variable+"_min"] = minimum
+                conditions.append("({0} >= {0}_min)".format(column_variable))
+            if maximum is not None:
+                condition_variables[column_variable+"_max"] = maximum
+                conditions.append("({0} <= {0}_max)".format(column_variable))
+        else:
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            condition_variables[column_variable+"_value"] = value
+            conditions.append("({0} == {0}_value)".format(column_variable))
+
+    return table.get_where_list(" & ".join(conditions), condvars=condition_variables, sort=True)
+
+# select rows from an index table stored with store_index_table, reading only the matching rows from disk. where is used as in index_coordinates
+def index_select(index_store: pd.HDFStore, table_name, where=None, columns=None) -> pd.DataFrame:
+    if not where:
+        return index_store.select(table_name, columns=columns)
+
+    coordinates = index_coordinates(index_store, table_name, where)
+
+    if len(coordinates) == 0:
+        return index_store.select(table_name, start=0, stop=0, columns=columns)
+
+    return index_store.select(table_name, where=coordinates, columns=columns)
+
+# update the values of a data column on the rows of an index table at the designated coordinates, without rewriting the table.
+# String values longer than the size reserved for the column when the table was stored would be truncated, thus in this case the table is rewritten with a larger column
+def update_index_column(index_store: pd.HDFStore, table_name, coordinates, column, values):
+    if len(coordinates) == 0:
+        return
+
+    table = index_store.get_storer(table_name).table
+
+    values = np.asarray(values)
+    if values.dtype.kind in ('U', 'O'):
+        encoded_values = np.char.encode(values.astype(str), "utf-8")
+        if encoded_values.dtype.itemsize > table.coldtypes[column].itemsize:
+            log_message("Values of {} on {} exceed {} bytes. The table is rewritten".format(column, table_name, table.coldtypes[column].itemsize))
+            dataframe = index_store.select(table_name)
+            dataframe.iloc[np.asarray(coordinates), dataframe.columns.get_loc(column)] = values.astype(str)
+            store_index_table(index_store, table_name, dataframe)
+            return
+        values = encoded_values
+
+    rows = table.read_coordinates(coordinates)
+    rows[column] = values
+
+    table.modify_coordinates(coordinates, rows)
+    table.flush()
+
+# site assigned to files without an equipment ID on the site index, as done by the indexer
+UNKNOWN_SITE = "unknown"
+
+# site of each row of an index table, given by the equipment ID stored on the site index for the file referred by the row
+def site_of_rows(dataframe: pd.DataFrame, site_index: pd.DataFrame) -> pd.Series:
+    # site index tables created without the file name column can't be related to the files, thus all rows are assigned to a single site
+    if cn.FILENAME_ATTRIBUTE not in site_index.columns:
+        return pd.Series(UNKNOWN_SITE, index=dataframe.index)
+
+    file_site = pd.Series(site_index[H5.CRFS_HOSTNAME].to_numpy(), index=site_index[cn.FILENAME_ATTRIBUTE].to_numpy())
+    file_site = file_site[~file_site.index.duplicated(keep='first')]
+
+    return dataframe[cn.FILENAME_ATTRIBUTE].map(file_site).fillna(UNKNOWN_SITE)
+
+# apply the function to each partition, using a pool of worker process if more than one worker is requested. Results are returned in the same order as the partitions
+def map_partitions(function, partitions, number_of_workers=cn.MERGE_WORKERS):
+    if number_of_workers < 1:
+        number_of_workers = os.cpu_count()
+
+    # do not spawn more process than partitions to process
+    number_of_workers = min(number_of_workers, len(partitions))
+
+    if number_of_workers > 1:
+        with Pool(processes=number_of_workers) as worker_pool:
+            return worker_pool.map(function, partitions, chunksize=1)
+
+    return [function(partition) for partition in partitions]
+
 # program log function
 def log_message (message):
     process_timestamp = datetime.now()
     print("{}: ".format(process_timestamp)+message)
 
+# compute a hash of the file content, reading the file in blocks to limit memory usage
+def file_content_hash(file_name) -> str:
+    content_hash = hashlib.sha1()
+    with open(file_name, 'rb') as file_object:
+        for block in iter(lambda: file_object.read(cn.HASH_BLOCK_SIZE), b''):
+            content_hash.update(block)
+
+    return content_hash.hexdigest()
+
 # quick plot function for dataframe
 def plot_dataframe(dataframe: pd.DataFrame, x_label = "Frequency[Hz]", y_label = ""):
     xy_array = dataframe.to_numpy(dtype='float32')
@@ -136,6 +1008,13 @@ def plot_dataframe(dataframe: pd.DataFrame, x_label = "Frequency[Hz]", y_label =
     plt.ylabel(y_label)
     plt.show()
 
+# plot a channel spectrogram stored by merge_channel_spectrogram, reading the level of the overview pyramid that fits the resolution of the current figure
+def plot_spectrogram(data_store: pd.HDFStore, group_name, statistic=cn.OVERVIEW_MAXIMUM_DATASET):
+    figure = plt.gcf()
+    figure_width, figure_height = figure.get_size_inches()*figure.dpi
+
+    plot_dataframe(read_spectrogram_overview(data_store, group_name, int(figure_height), int(figure_width), statistic))
+
 # call pandas tables to visualize the dataframe. Will halt execution
 class table_dataframe(Frame):
 
@@ -6,6 +6,23 @@ FOLDER_TO_GET_FILES = "/home/lobao/TFM_Code/OutBox/"
 FILE_TYPE = "*.h5"
 FOLDER_TO_STORE_FILES = "/home/lobao/TFM_Code/Repository"
 
+# Parallel processing control
+INDEXING_WORKERS = 0 # number of process used for file indexing. 0 to use all available cores, 1 to index serially
+INDEXING_CHUNK_SIZE = 8 # number of files sent to each worker at a time
+MERGE_WORKERS = 0 # number of process used to merge the data from different sites. 0 to use all available cores, 1 to merge serially
+SPECTROGRAM_MERGE_WORKERS = 0 # number of process used to merge the channel spectrograms. 0 to use all available cores, 1 to merge serially
+
+# Source file access control for the merge scripts
+OPEN_FILES_CACHE_SIZE = 64 # maximum number of source files kept open at the same time
+PROFILE_MERGE_FILE_MAJOR = True # if True, each source file is read once for all channels. If False, channels are merged one at a time
+
+# Output control for the data file
+OUTPUT_BATCH_SIZE = 32 # number of datasets and attribute updates buffered before being written to the data file
+SPECTROGRAM_CHUNK_ROWS = 1024 # number of traces on each chunk of the merged spectrograms. Also limits the number of traces held in memory while merging
+SPECTROGRAM_PYRAMID_TIME_FACTOR = 4 # number of traces of each level of the spectrogram overview pyramid combined into one trace of the next level
+SPECTROGRAM_PYRAMID_FREQUENCY_FACTOR = 2 # number of frequency bins of each level of the spectrogram overview pyramid combined into one bin of the next level
+SPECTROGRAM_PYRAMID_MINIMUM_TRACES = 512 # levels are added to the spectrogram overview pyramid until the number of traces is not above this
+
 # constants used as label for harmonization with the HDF5 ontology used
 FILENAME_ATTRIBUTE = "File Name"
 GROUPNAME_ATTRIBUTE = "Group Name"
@@ -13,16 +30,47 @@ CHANNEL_ID = "Channel ID"
 
 INDEX_FILENAME = "index.h5"
 DATA_FILENAME = "data.h5"
+VALIDATION_CACHE_FILENAME = "validation.h5"
+LOCK_FILE_EXTENSION = ".lock" # sidecar file locked while the index or the validation cache file is open
 
 FILE_INDEX = "File_Index"
 CHANNEL_INDEX = "Channel_Index"
 SITE_INDEX = "Site_Index"
+FILE_MANIFEST = "File_Manifest"
+
+# Size reserved for string columns on the index tables
+INDEX_FILENAME_SIZE = 256
+INDEX_GROUPNAME_SIZE = 64
+INDEX_CHANNEL_ID_SIZE = 32
+INDEX_HOSTNAME_SIZE = 64
+INDEX_HASH_SIZE = 40
+INDEX_MESSAGE_SIZE = 256 # longer validation messages are truncated
+
+# Incremental indexing control. The manifest stores the size and modification time of each indexed file
+INCREMENTAL_INDEXING = True # if False, all files are indexed on every run
+MANIFEST_CONTENT_HASH = False # if True, a content hash is also stored and files with unchanged content are not re-indexed
+HASH_BLOCK_SIZE = 1024*1024 # in bytes
+INCREMENTAL_CHANNEL_MERGE = True # if False, all channels are consolidated again from the channel index on every run
+
+FILE_SIZE = "File size"
+FILE_MODIFICATION_TIME = "File modification time"
+FILE_CONTENT_HASH = "File content hash"
+
+# File validation cache
+FILE_VALIDATION = "File_Validation"
+FILE_IS_VALID = "Is valid"
+FILE_VALIDATION_MESSAGE = "Validation message"
 
 CHANNEL_DATA_TABLE = "Channel_Data"
 SITE_DATA_TABLE = "Site_Data"
 NOISE_PROFILE = "Noise_Profile"
 CHANNEL_MEAN_LEVEL_CATALOG = "Channel_Mean_Level_Catalog"
 CHANNEL_FREQUENCY_CATALOG = "Channel_Frequency_Catalog"
+TIMESTAMP_DATASET = "Timestamp" # time axis of the merged spectrograms, in seconds
+TIMESTAMP_CHUNK_RANGE_DATASET = "Timestamp chunk range" # minimum and maximum time of the traces on each chunk of the merged spectrograms
+SPECTROGRAM_OVERVIEW_GROUP = "Overview" # group with the levels of the overview pyramid of the merged spectrograms, named by the level number
+OVERVIEW_MAXIMUM_DATASET = "Maximum"
+OVERVIEW_MEAN_DATASET = "Mean"
 
 CHANNEL_INNER_EDGE_INITIAL_FREQUENCY = "Channel inner edge initial frequency"
 CHANNEL_INNER_EDGE_FINAL_FREQUENCY = "Channel inner edge final frequency"
@@ -1,29 +1,40 @@
 #!/usr/bin/python3
 
-# This code runs on two parallel process that may spawn several others.
-# First process uses inotify to monitor a folder for access on files. 
-# Once a file of the designated extension is accessed, its name is stored on the list for processing. ( queue )
-# Each new access on the file, e.g. appending a new block to it, the access time on the list is updated
-# Also, on the event of file access, the second watchdog is spawned
-# The second watchdog process monitor the list for items that don't have any access for a period of time, allowing a slow transfer to complete,
-# The second watchdog process monitor perform the following actions:
-#   1. Move the file to a working folder if it is not accessed for a period of time.
+# This code runs an asyncio event loop that may spawn several decoder process.
+# Inotify is used to monitor a folder tree for access on files. Each first level subfolder is the inbox of one sensor. The blocking inotify reader runs on a separate thread and forwards the events to the event loop as an async stream.
+# Each file of the designated extension has its own quiet period timer on the event loop:
+#   - A write on the file (IN_MODIFY) restarts the timer with a long grace period, allowing a slow transfer to complete
+#   - Closing the file after writing (IN_CLOSE_WRITE) or moving it into the folder (IN_MOVED_TO) restarts the timer with a short period, since the transfer is considered complete
+# Once the timer expires, the file is submitted to the decode scheduler, that limits the number of parallel process and the memory they use.
+# The scheduler keeps one bounded run queue for each sensor and shares the workers among them, such as that one sensor can't starve the others.
+# When started by the scheduler, the decode task perform the following actions:
+#   1. Move the file to a working folder, keeping the path relative to the watched folder.
 #   2. Execute a call for an external program with several paramenters, including the file name and variants for output names
-#   3. Monitor the external program execution, many parallel threads can be monitored, as many as there are files to process
+#   3. Await the external program execution, many parallel process can be awaited, up to the number of workers of the scheduler
 #   4. Move files to archive or error folders after execution, according to the result.
-#   5. Stop the second watchdog timer if there is no files on the queue or process to monitor
-
-# TODO: Capture and process the text output from the program into a log file.
-# TODO: Organize activity log in JSON format
+# After a successful decode, the resulting file is placed on a queue and appended to the index used by the data processing scripts by a separate task, without holding the decode slot.
+# The state of each file is stored on a persistent queue. At startup, files left on the inbox and work folders are reconciled with the queue and scheduled again, up to a maximum number of decode attempts.
+# The decoder output is read asynchronously through pipes and one JSON record for each file is written to a size rotated activity log.
 
 import os
-import subprocess
+import time
+import functools
+import json
+import asyncio
+import logging
+import logging.handlers
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
-from threading import Timer
 
 import inotify.adapters
 
+from ingestion_scheduler import DecodeScheduler
+import ingestion_queue as iq
+import index_h5_files
+from ingestion_metrics import IngestionMetrics
+
 # constants that control the script
 # TODO: Change to load from the control database or configuration file. Maybe use this second option and add event trigger to reload configuration on changes
 FOLDER_TO_WATCH = "/home/lobao/TFM_Code/InBox"
@@ -36,176 +47,397 @@ DESTINATION_FILE_EXTENSION = ".h5"
 COMMAND_TO_PERFORM = ["/home/lobao/TFM_Code/decode", "-d", "1", "-u", "1"]
 INPUT_FILENAME_COMMAND_OPTION = ["-f"]
 OUTPUT_FILENAME_COMMAND_OPTION = ["-o"]
-TIME_TO_FINISH_FILE_TRANSFER = timedelta(seconds=60)
-QUEUE_CHECK_PERIOD = 10
-
-# class used for multithreading the file processing with delay to accommodate slow transfer of large files
-class WatchDog(object):
-    # initialization method to the WatchDog
-    def __init__(self, interval):
-        self._timer     = None
-        self.interval   = interval
-        self.is_running = False
-        self.file_queue = dict()
-        self.decode_running_process = dict()
-
-    # method that is run each periodic interval
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.run_decode()
+TIME_TO_FINISH_FILE_TRANSFER = timedelta(seconds=60) # quiet period after the last write, used if the file is not closed
+TIME_AFTER_FILE_CLOSE = timedelta(milliseconds=100) # quiet period after the file is closed or moved into the folder
+WATCH_RECURSIVELY = True # watch all subfolders, each first level subfolder being the inbox of one sensor
+QUEUE_DATABASE = "/home/lobao/TFM_Code/ingestion_queue.sqlite"
+INDEX_AFTER_DECODE = True # append each decoded file to the index as soon as it is created
+MAXIMUM_DECODE_ATTEMPTS = 3 # interrupted decodes of a file, e.g. by a decoder crash or a host restart, after which the file is moved to the error folder instead of being decoded again
+
+# activity log control. One JSON record for each file is written per line
+ACTIVITY_LOG_FILE = "/home/lobao/TFM_Code/ingestion_log.jsonl"
+ACTIVITY_LOG_MAX_SIZE = 10*1024*1024 # in bytes
+ACTIVITY_LOG_BACKUP_COUNT = 10
+DECODER_OUTPUT_TAIL_SIZE = 4096 # number of characters kept from the end of the decoder stdout and stderr
+
+# metrics control
+METRICS_PORT = 9101 # local HTTP port where the metrics are served in the Prometheus text format. 0 to disable
+METRICS_FILE = "" # file where the metrics are appended periodically. Empty to disable
+METRICS_WRITE_PERIOD = 60 # in seconds
+METRICS_FILE_ROTATION_HOURS = 24
+METRICS_FILE_BACKUP_COUNT = 7
+
+# decode scheduler control
+DECODE_WORKERS = 0 # maximum number of parallel decoder process. 0 to use the number of cores
+DECODE_MEMORY_BUDGET = 0 # maximum memory in bytes expected to be used by the running decoders. 0 to disable
+DECODE_MEMORY_PER_INPUT_BYTE = 4.0 # estimate of the decoder memory usage as a factor of the input file size
+DECODE_RUN_QUEUE_SIZE = 64 # maximum number of files waiting on the run queue of each sensor, further files are kept on the inbox until there is space
+DECODE_SHARD_MAX_WORKERS = 0 # maximum number of parallel decoder process for a single sensor. 0 to allow the use of workers left idle by other sensors
+DECODE_AGE_WEIGHT = 1024*1024 # priority increase, in bytes of file size, for each second a file waits on the queue
+
+# inotify events that signal the end of the file transfer
+TRANSFER_COMPLETE_EVENTS = ('IN_CLOSE_WRITE', 'IN_MOVED_TO')
+
+# read a stream until its end, keeping only the tail of the data. Reading continuously avoid the child process to block on a full pipe
+async def read_output_tail(stream, tail_size):
+    output_tail = bytearray()
+    while True:
+        output_block = await stream.read(65536)
+        if not output_block:
+            break
+        output_tail += output_block
+        del output_tail[:-tail_size]
+
+    return output_tail.decode("utf-8", errors="replace")
+
+# create the logger used to write the activity log, rotating the file by size
+def create_activity_logger(file_name, max_size, backup_count):
+    activity_logger = logging.getLogger("ingestion_activity")
+    activity_logger.propagate = False
+    activity_logger.setLevel(logging.INFO)
+    activity_logger.addHandler(logging.handlers.RotatingFileHandler(file_name, maxBytes=max_size, backupCount=backup_count))
+
+    return activity_logger
+
+# class used to process the files on an asyncio event loop, with a quiet period timer for each file to accommodate slow transfer of large files
+class IngestionEngine(object):
+    # initialization method to the IngestionEngine
+    def __init__(self):
+        self.loop = None
+        self.event_queue = None
+        self.folder_to_watch = None
+        self.file_timers = dict()
+        self.first_event_times = dict()
+        self.activity_logger = None
+        self.scheduler = None
+        self.metrics = None
+        # metrics server and the task writing the metrics file, kept to be stopped on shutdown
+        self.metrics_server = None
+        self.metrics_task = None
+        self.ingestion_queue = None
+        # tasks submitting files to the scheduler, referenced until finished such as that they are not garbage collected while waiting for space on the run queue
+        self.submit_tasks = set()
+        # the index file is updated by a single thread, such as that updates are serialized and the event loop is not blocked
+        self.index_executor = ThreadPoolExecutor(max_workers=1)
+        # decoded files waiting to be appended to the index and the task that appends them
+        self.index_queue = None
+        self.index_task = None
+
+    # read inotify events on a separate thread, since the inotify adapter is blocking, and forward them to the event loop
+    def _read_events(self, inotify_adapter):
+        for event in inotify_adapter.event_gen(yield_nones=False):
+            self.loop.call_soon_threadsafe(self.event_queue.put_nowait, event)
+
+    # async stream of inotify events
+    async def events(self):
+        while True:
+            yield await self.event_queue.get()
+
+    # set the file on the queue or restart the quiet period if the file was already placed on the queue
+    def schedule_file(self, path, file_name, quiet_period):
+        source_file = path+"/"+file_name
+
+        # files already submitted for decoding are ignored
+        if source_file in self.scheduler:
+            return
+
+        file_timer = self.file_timers.pop(source_file, None)
+        if file_timer is not None:
+            file_timer.cancel()
+
+        self.file_timers[source_file] = self.loop.call_later(quiet_period.total_seconds(), self.start_decode, path, file_name)
+
+        # record and output message only when the file is placed on the queue, since there are many write events for each file
+        if file_timer is None:
+            self.first_event_times[source_file] = time.monotonic()
+            self.ingestion_queue.set_state(source_file, file_name, iq.QUEUED)
+            print("{}: Waiting. {} files on the queue".format(datetime.now(), self.file_timers.__len__()))
+
+    # sensor shard of a file, given by the first level subfolder of the watched folder where the file is placed. Files on the watched folder itself use an empty shard name
+    def shard_of(self, path):
+        relative_path = os.path.relpath(path, self.folder_to_watch)
+        if relative_path == os.curdir:
+            return ""
+        return relative_path.split(os.sep)[0]
+
+    # path of the source file on a destination folder, keeping the path relative to the watched folder such as that files with the same name from different sensors don't collide.
+    # The extension is replaced if designated and the subfolders are created if needed
+    def destination_of(self, folder, source_file, file_extension=None):
+        destination_file = os.path.join(folder, os.path.relpath(source_file, self.folder_to_watch))
+        if file_extension is not None:
+            destination_file = destination_file[:-FILE_EXTENSION_TO_WATCH.__len__()]+file_extension
+
+        os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+        return destination_file
+
+    # method called when the quiet period of the file expires. Submit the file to the scheduler using the file size as reference for the job length
+    def start_decode(self, path, file_name):
+        source_file = path+"/"+file_name
+        del self.file_timers[source_file]
+
+        try:
+            file_size = os.path.getsize(source_file)
+        except OSError as error:
+            print("{}: File {} can't be accessed: {}".format(datetime.now(), source_file, error))
+            return
+
+        submit_task = self.loop.create_task(self.scheduler.submit(source_file, file_size, self.run_decode, path, file_name, shard=self.shard_of(path)))
+        self.submit_tasks.add(submit_task)
+        submit_task.add_done_callback(functools.partial(self._submit_done, source_file))
+
+    # release the reference to the submit task, reporting failures
+    def _submit_done(self, source_file, submit_task):
+        self.submit_tasks.discard(submit_task)
+
+        if not submit_task.cancelled() and submit_task.exception() is not None:
+            print("{}: Failed to submit file {}: {}".format(datetime.now(), source_file, submit_task.exception()))
 
     # method that perform the action
-    def run_decode(self):
+    async def run_decode(self, path, file_name):
+        source_file = path+"/"+file_name
         call_timestamp = datetime.now()
-        queue_size = self.file_queue.__len__()
-        number_of_running_process = self.decode_running_process.__len__()
-        log_output = True
-
-        # if there is no process to monitor or file to process, stop watchdog timer
-        if number_of_running_process == 0 and queue_size == 0:
-            self.stop()
-        # else, if there is something to monitor
-        else:
-            # if there are files to process
-            if queue_size > 0:
-                # for each file on the queue list
-                for file_name in list(self.file_queue):
-                    # if enough time has passed since the last file access
-                    if call_timestamp > self.file_queue[file_name]+TIME_TO_FINISH_FILE_TRANSFER:
-                        # TODO: Include error handling for all file operations
-                        # move file to a work directory. This avoid retrigggering the inotify
-                        source_file = FOLDER_TO_WATCH+"/"+file_name
-                        work_file = FOLDER_TO_WORK+"/"+file_name
-                        os.rename(source_file, work_file)
-
-                        # create a filename for the output identical to the input
-                        file_extension_length = -FILE_EXTENSION_TO_WATCH.__len__()
-                        output_file = FOLDER_TO_PLACE_RESULTS + "/" + file_name[:file_extension_length]+DESTINATION_FILE_EXTENSION
-
-                        # Create the command list and execute
-                        bash_comand = COMMAND_TO_PERFORM+INPUT_FILENAME_COMMAND_OPTION
-                        bash_comand.append(work_file)
-                        bash_comand = bash_comand + OUTPUT_FILENAME_COMMAND_OPTION
-                        bash_comand.append(output_file)
-                        self.decode_running_process[file_name] = subprocess.Popen(bash_comand)
-
-                        # increment the counter for the number of running process
-                        number_of_running_process += 1
-
-                        # convert the comand to string and output the message to log
-                        bash_text = " ".join(bash_comand)
-                        print("{}: $".format(call_timestamp)+bash_text)
-
-                        # delete the filename from the queue and reset the queue_size variable
-                        del self.file_queue[file_name]
-                        queue_size = self.file_queue.__len__()
-
-                        # reset timer to be used for the next file on the queue
-                        call_timestamp = datetime.now()
-                    # else, if not enough time has passed since last file access
-                    else:
-                        # Select the appropriate message output according to the queue size
-                        if queue_size == 1:
-                            print("{}: Waiting. {} file on the queue".format(call_timestamp, queue_size))
-                        else:
-                            # for large queues, output only one message.
-                            if log_output:
-                                print("{}: Waiting. {} files on the queue".format(call_timestamp, queue_size))
-                                log_output = False
-            # if there are no files on the queue, output the corresponding message
-            else:
-                print("{}: No file on the queue".format(call_timestamp))
-
-            # if there are process running
-            if number_of_running_process > 0:
-                # for each process, associated to a file
-                for file_name in list(self.decode_running_process):
-                    # if the process has finished
-                    if self.decode_running_process[file_name].poll() is not None:
-                        # get the return code from the process
-                        program_returncode = self.decode_running_process[file_name].returncode
-
-                        # If the process finished with success
-                        if program_returncode == 0:
-                            # move file from the work folder to archive
-                            work_file = FOLDER_TO_WORK+"/"+file_name
-                            archive_file = FOLDER_TO_ARCHIVE+"/"+file_name
-                            os.rename(work_file, archive_file)
-                        # If the process failed
-                        else:
-                            # move the file from the work folder to the error folder for later debug
-                            call_timestamp = datetime.now()
-                            work_file = FOLDER_TO_WORK+"/"+file_name
-                            failed_file = FOLDER_TO_STORE_FAILED+"/"+file_name
-                            os.rename(work_file, failed_file)
 
-                            #print the corresponding error message
-                            print("{}: Process exited code: {}".format(call_timestamp, program_returncode))
-
-                        # remove the corresponding process from the monitoring list
-                        del self.decode_running_process[file_name]
-
-                # update the number of running process
-                number_of_running_process = self.decode_running_process.__len__()
-
-                # Output the message according to the number of process being monitored
+        decode_start_time = time.monotonic()
+        wait_time = decode_start_time-self.first_event_times.pop(source_file, decode_start_time)
+        self.metrics.decode_started(wait_time)
+
+        # record written to the activity log when the processing of the file ends
+        activity_record = {"file": source_file,
+                           "start time": call_timestamp.isoformat(),
+                           "wait time": wait_time}
+
+        # the end of the decode is recorded on the metrics once, either when the process finishes or when a file operation fails before it
+        file_size = 0
+        decode_is_recorded = False
+
+        try:
+            # TODO: Include error handling for all file operations
+            # move file to a work directory. This avoid retrigggering the inotify
+            work_file = self.destination_of(FOLDER_TO_WORK, source_file)
+            os.rename(source_file, work_file)
+            file_size = os.path.getsize(work_file)
+            self.ingestion_queue.set_state(source_file, file_name, iq.DECODING, file_size=file_size)
+            activity_record["file size"] = file_size
+
+            # create a filename for the output identical to the input
+            output_file = self.destination_of(FOLDER_TO_PLACE_RESULTS, source_file, DESTINATION_FILE_EXTENSION)
+
+            # Create the command list and execute
+            bash_comand = COMMAND_TO_PERFORM+INPUT_FILENAME_COMMAND_OPTION
+            bash_comand.append(work_file)
+            bash_comand = bash_comand + OUTPUT_FILENAME_COMMAND_OPTION
+            bash_comand.append(output_file)
+
+            # convert the comand to string and output the message to log
+            bash_text = " ".join(bash_comand)
+            print("{}: $".format(call_timestamp)+bash_text)
+            print("{}: Running {} process. {} files on the run queue".format(call_timestamp, self.scheduler.running_count(), self.scheduler.queued_count()))
+
+            activity_record["command"] = bash_comand
+
+            # wait for the process to finish without blocking the event loop. Output is read from both pipes while the process runs
+            decode_process = await asyncio.create_subprocess_exec(*bash_comand, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout_tail, stderr_tail, program_returncode = await asyncio.gather(read_output_tail(decode_process.stdout, DECODER_OUTPUT_TAIL_SIZE),
+                                                                               read_output_tail(decode_process.stderr, DECODER_OUTPUT_TAIL_SIZE),
+                                                                               decode_process.wait())
+            decode_time = time.monotonic()-decode_start_time
+            self.metrics.decode_finished(program_returncode == 0, file_size, decode_time)
+            decode_is_recorded = True
+
+            activity_record["return code"] = program_returncode
+            activity_record["decode time"] = decode_time
+            activity_record["stdout tail"] = stdout_tail
+            activity_record["stderr tail"] = stderr_tail
+
+            # If the process finished with success
+            if program_returncode == 0:
+                # record the result and move file from the work folder to archive. If interrupted before the move, the file is archived on restart without decoding again
+                self.ingestion_queue.set_state(source_file, file_name, iq.DONE, return_code=program_returncode)
+                archive_file = self.destination_of(FOLDER_TO_ARCHIVE, source_file)
+                os.rename(work_file, archive_file)
+                activity_record["result"] = iq.DONE
+
+                # append the new file to the index. The file is placed on the index queue, such as that the decode slot is released even if the index is locked
+                if INDEX_AFTER_DECODE:
+                    self.index_queue.put_nowait(output_file)
+            # If the process failed
+            else:
+                # move the file from the work folder to the error folder for later debug
+                self.ingestion_queue.set_state(source_file, file_name, iq.FAILED, return_code=program_returncode)
                 call_timestamp = datetime.now()
-                if number_of_running_process == 0:
-                    print("{}: No running process".format(call_timestamp))
+                failed_file = self.destination_of(FOLDER_TO_STORE_FAILED, source_file)
+                os.rename(work_file, failed_file)
+                activity_record["result"] = iq.FAILED
+
+                #print the corresponding error message
+                print("{}: Process exited code: {}".format(call_timestamp, program_returncode))
+        except OSError as error:
+            print("{}: Failed to process file {}: {}".format(datetime.now(), source_file, error))
+            activity_record["result"] = "error"
+            activity_record["error"] = str(error)
+
+            if not decode_is_recorded:
+                self.metrics.decode_finished(False, file_size, time.monotonic()-decode_start_time)
+        finally:
+            activity_record["end time"] = datetime.now().isoformat()
+            self.activity_logger.info(json.dumps(activity_record))
+
+            # Output the message according to the number of process being monitored, not including the one that just finished
+            call_timestamp = datetime.now()
+            number_of_running_process = self.scheduler.running_count()-1
+            if number_of_running_process == 0:
+                print("{}: No running process".format(call_timestamp))
+            else:
+                print("{}: Running {} process".format(call_timestamp, number_of_running_process))
+
+    # append the decoded files to the index, taking at once all files waiting on the index queue, such as that files decoded while the index is locked, e.g. by a batch script, are appended together.
+    # Errors are reported but do not affect the file processing, the files can be indexed later by index_h5_files
+    async def index_outputs(self):
+        while True:
+            output_files = [await self.index_queue.get()]
+            while not self.index_queue.empty():
+                output_files.append(self.index_queue.get_nowait())
+
+            try:
+                await self.loop.run_in_executor(self.index_executor, index_h5_files.append_to_index, output_files)
+                print("{}: Indexed files {}".format(datetime.now(), ", ".join(output_files)))
+            except Exception as error:
+                print("{}: Failed to index files {}: {}".format(datetime.now(), ", ".join(output_files), error))
+
+    # reconcile the folders with the persistent queue, recovering files left from a previous execution
+    def recover(self, folder_to_watch):
+        self.folder_to_watch = folder_to_watch
+        file_extension_length = -FILE_EXTENSION_TO_WATCH.__len__()
+
+        # files on the work folder were under decoding when the watchdog stopped. The work folder keeps the path relative to the watched folder, giving the source file
+        for path, _, file_names in os.walk(FOLDER_TO_WORK):
+            for file_name in sorted(file_names):
+                if file_name[file_extension_length:] != FILE_EXTENSION_TO_WATCH:
+                    continue
+
+                work_file = os.path.join(path, file_name)
+                source_file = os.path.join(folder_to_watch, os.path.relpath(work_file, FOLDER_TO_WORK))
+                file_state = self.ingestion_queue.state(source_file)
+
+                # if the result was recorded, complete the file move. Files that can't be moved are left on the work folder and marked as failed
+                try:
+                    if file_state == iq.DONE:
+                        os.rename(work_file, self.destination_of(FOLDER_TO_ARCHIVE, source_file))
+                    elif file_state == iq.FAILED:
+                        os.rename(work_file, self.destination_of(FOLDER_TO_STORE_FAILED, source_file))
+                    # if the decoding was interrupted too many times, the file may be crashing the decoder or the host and is set aside
+                    elif self.ingestion_queue.attempts(source_file) >= MAXIMUM_DECODE_ATTEMPTS:
+                        os.rename(work_file, self.destination_of(FOLDER_TO_STORE_FAILED, source_file))
+                        self.ingestion_queue.set_state(source_file, file_name, iq.FAILED)
+                        print("{}: File {} was interrupted on {} decode attempts and was marked as failed".format(datetime.now(), source_file, self.ingestion_queue.attempts(source_file)))
+                    # else, decoding was interrupted and the file is moved back to the inbox to be decoded again
+                    else:
+                        os.makedirs(os.path.dirname(source_file), exist_ok=True)
+                        os.rename(work_file, source_file)
+                        print("{}: Recovered interrupted file {}".format(datetime.now(), source_file))
+                except OSError as error:
+                    print("{}: Failed to recover file {}: {}".format(datetime.now(), work_file, error))
+                    self.ingestion_queue.set_state(source_file, file_name, iq.FAILED)
+
+        # pending files that are no longer on the inbox were completed or removed while the watchdog was stopped
+        for source_file, file_name in self.ingestion_queue.files_in_state(*iq.PENDING_STATES):
+            if not os.path.exists(source_file):
+                if os.path.exists(os.path.join(FOLDER_TO_ARCHIVE, os.path.relpath(source_file, folder_to_watch))):
+                    self.ingestion_queue.set_state(source_file, file_name, iq.DONE)
                 else:
-                    print("{}: Running {} process".format(call_timestamp, number_of_running_process))
-            # else, if there are no process being monitored
+                    self.ingestion_queue.set_state(source_file, file_name, iq.FAILED)
+                    print("{}: File {} is missing and was marked as failed".format(datetime.now(), source_file))
+
+        # files waiting on the inboxes are not reported by inotify. Schedule them considering the time since the last modification
+        current_time = datetime.now()
+        for path, folder_names, file_names in os.walk(folder_to_watch):
+            if not WATCH_RECURSIVELY:
+                folder_names.clear()
+
+            for file_name in sorted(file_names):
+                source_file = path+"/"+file_name
+                if file_name[file_extension_length:] == FILE_EXTENSION_TO_WATCH and os.path.isfile(source_file):
+                    idle_time = current_time-datetime.fromtimestamp(os.path.getmtime(source_file))
+                    self.schedule_file(path, file_name, max(TIME_TO_FINISH_FILE_TRANSFER-idle_time, TIME_AFTER_FILE_CLOSE))
+
+    # main loop. Consume the inotify events and set the quiet period timer for each file
+    async def run(self, folder_to_watch):
+        self.loop = asyncio.get_running_loop()
+        self.event_queue = asyncio.Queue()
+        self.folder_to_watch = folder_to_watch
+        self.scheduler = DecodeScheduler(number_of_workers=DECODE_WORKERS,
+                                         memory_budget=DECODE_MEMORY_BUDGET,
+                                         memory_per_input_byte=DECODE_MEMORY_PER_INPUT_BYTE,
+                                         queue_size=DECODE_RUN_QUEUE_SIZE,
+                                         age_weight=DECODE_AGE_WEIGHT,
+                                         shard_max_workers=DECODE_SHARD_MAX_WORKERS)
+        self.ingestion_queue = iq.IngestionQueue(QUEUE_DATABASE)
+        self.activity_logger = create_activity_logger(ACTIVITY_LOG_FILE, ACTIVITY_LOG_MAX_SIZE, ACTIVITY_LOG_BACKUP_COUNT)
+
+        # start the metrics outputs
+        self.metrics = IngestionMetrics(lambda: self.file_timers.__len__()+self.scheduler.pending_count(), self.scheduler.running_count)
+        if METRICS_PORT > 0:
+            self.metrics_server = await self.metrics.serve(METRICS_PORT)
+        if METRICS_FILE:
+            self.metrics_task = self.loop.create_task(self.metrics.write_periodically(METRICS_FILE, METRICS_WRITE_PERIOD, METRICS_FILE_ROTATION_HOURS, METRICS_FILE_BACKUP_COUNT))
+
+        # start the task that appends the decoded files to the index
+        self.index_queue = asyncio.Queue()
+        self.index_task = self.loop.create_task(self.index_outputs())
+
+        # the background tasks and the metrics server are stopped when the main loop ends, e.g. when the program is interrupted
+        try:
+            # create notification object to monitor the folder. Using Linux Inotify
+            # The tree adapter also watch all subfolders, including the ones created later, e.g. for a new sensor
+            if WATCH_RECURSIVELY:
+                inotify_adapter = inotify.adapters.InotifyTree(folder_to_watch)
             else:
-                # output log message
-                print("{}: No running process".format(call_timestamp))
+                inotify_adapter = inotify.adapters.Inotify()
+                inotify_adapter.add_watch(folder_to_watch)
+
+            # start the thread that read the events
+            event_thread = threading.Thread(target=self._read_events, args=(inotify_adapter,), daemon=True)
+            event_thread.start()
+
+            # resume the processing of files left from a previous execution
+            self.recover(folder_to_watch)
+
+            #store the file extention length for later substring extraction from the filename
+            file_extension_length = -FILE_EXTENSION_TO_WATCH.__len__()
+
+            async for event in self.events():
+                (_, type_names, path, filename) = event
+
+                #print("type_names: {}, path: {}, filename: {}".format(type_names, path, filename))
+                if any(type_name in type_names for type_name in TRANSFER_COMPLETE_EVENTS+('IN_MODIFY',)):
+                    # check if the file has the .bin extension
+                    path_plus_filename = path+"/"+filename
+                    if filename[file_extension_length:] == FILE_EXTENSION_TO_WATCH:
+                        # transfer is complete if the file was closed or moved into the folder, else wait for the transfer to finish
+                        if any(type_name in type_names for type_name in TRANSFER_COMPLETE_EVENTS):
+                            self.schedule_file(path, filename, TIME_AFTER_FILE_CLOSE)
+                        else:
+                            self.schedule_file(path, filename, TIME_TO_FINISH_FILE_TRANSFER)
+                    else:
+                        print("{}: Ignored event: {} on file {}.".format(datetime.now(), ",".join(type_names), path_plus_filename))
+        finally:
+            await self.stop()
 
-    # method that start the timer
-    def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+    # stop the background tasks and the metrics server
+    async def stop(self):
+        for task in (self.metrics_task, self.index_task):
+            if task is not None:
+                task.cancel()
 
-    # method that stop the timer
-    def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
 
 def _main():
     print("{}: Initializing watch for files with ""{}"" extension on {} folder".format(datetime.now(), FILE_EXTENSION_TO_WATCH, FOLDER_TO_WATCH))
 
-    #store the file extention length for later substring extraction from the filename
-    file_extension_length = -FILE_EXTENSION_TO_WATCH.__len__()
-
-    # create notification object to monitor the folder
-    i = inotify.adapters.Inotify()
-
-    # create a process to watch the folder and generate events when the folder is changed. Using Linux Inotify
-    i.add_watch(FOLDER_TO_WATCH)
-
-    # create a timer to keep a list of files and act on than after a delay
-    watchdog_timer = WatchDog(QUEUE_CHECK_PERIOD)
-
-    for event in i.event_gen(yield_nones=False):
-        (_, type_names, path, filename) = event
-
-        # look for the event 'IN_MODIFY', associated with the file write operation
-        #print("type_names: {}, path: {}, filename: {}".format(type_names, path, filename))
-        if 'IN_MODIFY' in type_names:
-            # check if the file has the .bin extension
-            path_plus_filename = path+"/"+filename
-            if filename[file_extension_length:] == FILE_EXTENSION_TO_WATCH:
-                # get the file access timestamp as the last activity reference
-                file_access_timestamp = datetime.fromtimestamp(os.path.getatime(path_plus_filename))
-
-                # set the file on the watchdog timer queue or reset the reference time if the file was already placed on the queue
-                watchdog_timer.file_queue[filename] = file_access_timestamp
-
-                # start the timer. Call actually do something only if the timer is nor already started
-                watchdog_timer.start()
-            else:
-                print("{}: Ignored event: IN_MODIFY on file {}.".format(datetime.now(), path_plus_filename))
+    ingestion_engine = IngestionEngine()
+    asyncio.run(ingestion_engine.run(FOLDER_TO_WATCH))
 
 if __name__ == '__main__':
     _main()
@@ -3,9 +3,13 @@
 # # File Indexer
 # This script perform the following tasks
 # - Read files on designated folder and create an index with its main characteristics, to be used for later data processing
+# - Files are processed in parallel by a pool of worker process, each returning plain records with the file metadata
+# - A manifest with the size and modification time of each file is kept on the index, allowing later runs to process only new or changed files
 
 # Import standard libraries
 import glob
+import os
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 
@@ -16,137 +20,347 @@ import h5_spectrum as H5
 import cortex_names as cn
 import cortex_lib as cl
 
+# columns used on each index table
+FILE_INDEX_COLUMNS = [cn.FILENAME_ATTRIBUTE,
+                      H5.INITIAL_FREQUENCY_ATTRIBUTE,
+                      H5.FINAL_FREQUENCY_ATTRIBUTE,
+                      H5.START_TIME_COARSE_ATTRIBUTE,
+                      H5.STOP_TIME_COARSE_ATTRIBUTE]
+
+SITE_INDEX_COLUMNS = [H5.LATITUDE_MEMBER,
+                      H5.LONGITUDE_MEMBER,
+                      H5.CRFS_HOSTNAME,
+                      cn.FILENAME_ATTRIBUTE]
+
+CHANNEL_INDEX_COLUMNS = [cn.CHANNEL_ID,
+                         cn.FILENAME_ATTRIBUTE,
+                         cn.GROUPNAME_ATTRIBUTE,
+                         H5.START_TIME_COARSE_ATTRIBUTE,
+                         H5.STOP_TIME_COARSE_ATTRIBUTE,
+                         H5.AVERAGE_CHANNEL_SAMPLE_RATE,
+                         H5.CHANNEL_EDGE_INITIAL_FREQUENCY,
+                         cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY,
+                         H5.CHANNEL_CORE_INITIAL_FREQUENCY,
+                         H5.CHANNEL_CORE_FINAL_FREQUENCY,
+                         cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY,
+                         H5.CHANNEL_EDGE_FINAL_FREQUENCY]
+
+MANIFEST_COLUMNS = [cn.FILENAME_ATTRIBUTE,
+                    cn.FILE_SIZE,
+                    cn.FILE_MODIFICATION_TIME,
+                    cn.FILE_CONTENT_HASH]
+
+# Extract the metadata from a single file into plain records.
+# Return a tuple with the file record, the site record (None if the file has no site information) and the list of channel records
+def read_file_records(file_name):
+
+    file_record = [file_name, 0.0, 0.0, 0.0, 0.0]
+    site_record = None
+    channel_records = []
+
+    # files are tested against the standard by index_file before being read
+    file_object = h5py.File(file_name, 'r')
+
+    # Get the site coordinates. Statistics are returned as the raw compound values and converted to Normal objects by the parent process
+    if H5.SITE_GEOLOCATION_DATASET in file_object:
+        site_attributes = cl.read_attributes(file_object[H5.SITE_GEOLOCATION_DATASET])
+        site_record = [site_attributes[H5.LATITUDE_STATISTICS_ATTRIBUTE],
+                       site_attributes[H5.LONGITUDE_STATISTICS_ATTRIBUTE],
+                       "unknown",
+                       file_name]
+
+    # Get the unit information from the logbook. Only the first equipment ID is retrived
+    if H5.LOGBOOK_DATASET in file_object:
+        equipment_id = cl.logbook_entry(file_object[H5.LOGBOOK_DATASET], H5.CRFS_HOSTNAME)
+        if equipment_id is not None:
+            if site_record is None:
+                site_record = [np.NaN, np.NaN, "unknown", file_name]
+            site_record[2] = equipment_id
+
+    # Test if there is a noise group. The noise group contains all traces and thus reference to the time and frequency scope of the file content
+    if H5.NOISE_DATA_GROUP in file_object:
+
+        # get all sub groups within the noise group
+        for sub_group_name, sub_group in file_object[H5.NOISE_DATA_GROUP].items():
+
+            # if sub group corresponds to em spectrum group. Noise group also include the level profile group
+            if H5.SPECTROGRAM_CLASS in str(cl.read_attributes(sub_group)[H5.CLASS_ATTRIBUTE]):
+
+                # Get the frequency reference data from the frequency axis dataset
+                frequency_attributes = cl.read_attributes(sub_group[H5.FREQUENCY_DATASET])
+                file_record[1] = frequency_attributes[H5.INITIAL_FREQUENCY_ATTRIBUTE]
+                file_record[2] = frequency_attributes[H5.FINAL_FREQUENCY_ATTRIBUTE]
+
+                # Get the time reference data from the timestamp coarse dataset
+                timestamp_coarse_attributes = cl.read_attributes(sub_group[H5.TIMESTAMP_COARSE_DATASET])
+                file_record[3] = timestamp_coarse_attributes[H5.START_TIME_COARSE_ATTRIBUTE]
+                file_record[4] = timestamp_coarse_attributes[H5.STOP_TIME_COARSE_ATTRIBUTE]
+
+    if H5.CHANNEL_DATA_GROUP in file_object:
+
+        # get all sub groups within the channel group
+        for sub_group_name, sub_group in file_object[H5.CHANNEL_DATA_GROUP].items():
+
+            # read all group attributes at once
+            group_attributes = cl.read_attributes(sub_group)
+
+            # if sub group corresponds to activity profile group.
+            if H5.ACTIVITY_PROFILE_CLASS in str(group_attributes[H5.CLASS_ATTRIBUTE]):
+
+                channel_records.append(["",
+                                        file_name,
+                                        sub_group_name,
+                                        file_record[3],
+                                        file_record[4],
+                                        group_attributes[H5.AVERAGE_CHANNEL_SAMPLE_RATE],
+                                        group_attributes[H5.CHANNEL_EDGE_INITIAL_FREQUENCY],
+                                        group_attributes[H5.CHANNEL_EDGE_INITIAL_FREQUENCY], # channel edge inner frequency is equal to edge frequency for a single file
+                                        group_attributes[H5.CHANNEL_CORE_INITIAL_FREQUENCY],
+                                        group_attributes[H5.CHANNEL_CORE_FINAL_FREQUENCY],
+                                        group_attributes[H5.CHANNEL_EDGE_FINAL_FREQUENCY], # channel edge inner frequency is equal to edge frequency for a single file
+                                        group_attributes[H5.CHANNEL_EDGE_FINAL_FREQUENCY]])
+
+    # If there is no noise group
+    else:
+        # Issue error message and proceed to next file
+        cl.log_message("File {} does not include reference noise data and will be ignored".format(file_name))
+
+    file_object.close()
+
+    return file_record, site_record, channel_records
+
+# Test the file against the standard, if requested, and extract its metadata. Executed by the worker process.
+# Return a tuple with the records returned by read_file_records (None if the file does not follow the standard) and the result returned by cl.validate_file_status (None if the file was not tested)
+def index_file(file_name, validate=False):
+
+    cl.log_message("Processing file {}".format(file_name))
+
+    validation_result = None
+    if validate:
+        validation_result = cl.validate_file_status(file_name)
+        if validation_result is None or not validation_result[2]:
+            return None, validation_result
+
+    return read_file_records(file_name), validation_result
+
+# Extract the metadata from a list of files, using a pool of worker process if more than one worker is requested
+def index_files(files, number_of_workers=cn.INDEXING_WORKERS):
+
+    # skip files that do not follow the standard. Results are cached, such as that only new or modified files are tested, by the workers along with the indexing
+    file_validator = cl.FileValidator()
+    file_tasks = []
+    for file_name in files:
+        cached_result = file_validator.cached_result(file_name)
+        if cached_result is None:
+            file_tasks.append((file_name, True))
+        elif cached_result[2]:
+            file_tasks.append((file_name, False))
+
+    if number_of_workers < 1:
+        number_of_workers = os.cpu_count()
+
+    # do not spawn more process than files to process
+    number_of_workers = min(number_of_workers, len(file_tasks))
+
+    if number_of_workers > 1:
+        with Pool(processes=number_of_workers) as worker_pool:
+            # results are returned in the same order as the file list
+            file_results = worker_pool.starmap(index_file, file_tasks, chunksize=cn.INDEXING_CHUNK_SIZE)
+    else:
+        file_results = [index_file(file_name, validate) for file_name, validate in file_tasks]
+
+    # keep the results of the files tested by the workers and the records of the files that follow the standard
+    file_records = []
+    for (file_name, validate), (records, validation_result) in zip(file_tasks, file_results):
+        if validate and not file_validator.add_result(file_name, validation_result):
+            continue
+        file_records.append(records)
+    file_validator.close()
+
+    return file_records
+
+# Build the file, site and channel index tables from the records returned by index_file, in a single columnar step
+def build_index(file_records):
+
+    file_rows = [file_record for file_record, _, _ in file_records]
+    file_index = pd.DataFrame.from_records(file_rows, columns=FILE_INDEX_COLUMNS)
+    file_index = file_index.astype({column: 'float64' for column in FILE_INDEX_COLUMNS[1:]})
+
+    # site rows keep the position of the corresponding file on the file list as index
+    site_rows = []
+    site_row_positions = []
+    for row, (_, site_record, _) in enumerate(file_records):
+        if site_record is not None:
+            latitude, longitude, hostname, file_name = site_record
+            if not isinstance(latitude, float):
+                latitude_statistics = cl.Normal()
+                latitude_statistics.np_set(latitude)
+                latitude = latitude_statistics
+            if not isinstance(longitude, float):
+                longitude_statistics = cl.Normal()
+                longitude_statistics.np_set(longitude)
+                longitude = longitude_statistics
+            site_rows.append([latitude, longitude, hostname, file_name])
+            site_row_positions.append(row)
+    site_index = pd.DataFrame.from_records(site_rows, index=site_row_positions, columns=SITE_INDEX_COLUMNS)
+
+    channel_rows = [channel_record for _, _, channel_records in file_records for channel_record in channel_records]
+    channel_index = pd.DataFrame.from_records(channel_rows, columns=CHANNEL_INDEX_COLUMNS)
+    channel_index = channel_index.astype({column: 'float64' for column in CHANNEL_INDEX_COLUMNS[3:]})
+
+    return file_index, site_index, channel_index
+
+# Build the manifest with the signature of each file, used to identify new, changed and deleted files between runs
+def build_manifest(files):
+
+    manifest_rows = []
+    for file_name in files:
+        file_status = os.stat(file_name)
+        manifest_rows.append([file_name, file_status.st_size, file_status.st_mtime, ""])
+
+    manifest = pd.DataFrame.from_records(manifest_rows, columns=MANIFEST_COLUMNS)
+
+    return manifest.astype({cn.FILE_SIZE: 'int64', cn.FILE_MODIFICATION_TIME: 'float64'})
+
+# Compare the current manifest with the one stored on the index.
+# Return the updated manifest and the lists of new, changed and deleted files
+def compare_manifest(manifest, previous_manifest, use_content_hash=cn.MANIFEST_CONTENT_HASH):
+
+    current = manifest.set_index(cn.FILENAME_ATTRIBUTE)
+    previous = previous_manifest.set_index(cn.FILENAME_ATTRIBUTE)
+
+    new_files = current.index.difference(previous.index)
+    deleted_files = previous.index.difference(current.index)
+
+    # files present on both are considered changed if either the size or the modification time differ
+    common_files = current.index.intersection(previous.index)
+    changed_mask = (current.loc[common_files, cn.FILE_SIZE].to_numpy() != previous.loc[common_files, cn.FILE_SIZE].to_numpy()) | \
+                   (current.loc[common_files, cn.FILE_MODIFICATION_TIME].to_numpy() != previous.loc[common_files, cn.FILE_MODIFICATION_TIME].to_numpy())
+    changed_files = common_files[changed_mask]
+
+    if use_content_hash:
+        # keep the stored hash for unchanged files and compute it only for new and modified ones
+        current.loc[common_files, cn.FILE_CONTENT_HASH] = previous.loc[common_files, cn.FILE_CONTENT_HASH]
+        for file_name in new_files.union(changed_files):
+            current.loc[file_name, cn.FILE_CONTENT_HASH] = cl.file_content_hash(file_name)
+
+        # files that were touched or copied without changing the content are not re-indexed
+        same_content = current.loc[changed_files, cn.FILE_CONTENT_HASH].to_numpy() == previous.loc[changed_files, cn.FILE_CONTENT_HASH].to_numpy()
+        changed_files = changed_files[~same_content]
+
+    return current.reset_index(), new_files.tolist(), changed_files.tolist(), deleted_files.tolist()
+
+# Update the index tables stored on the index file, removing rows from deleted or changed files and appending the rows from new or changed files
+def update_index(index_store, files_to_index, files_to_remove):
+
+    file_index = index_store[cn.FILE_INDEX]
+    site_index = cl.read_site_index(index_store)
+    channel_index = index_store[cn.CHANNEL_INDEX]
+
+    # remove rows associated with files that were deleted or will be re-indexed
+    file_index = file_index[~file_index[cn.FILENAME_ATTRIBUTE].isin(files_to_remove)]
+    site_index = site_index[~site_index[cn.FILENAME_ATTRIBUTE].isin(files_to_remove)]
+    channel_index = channel_index[~channel_index[cn.FILENAME_ATTRIBUTE].isin(files_to_remove)]
+
+    # index the new files and append the resulting rows
+    new_file_index, new_site_index, new_channel_index = build_index(index_files(files_to_index))
+
+    file_index = pd.concat([file_index, new_file_index], ignore_index=True)
+    site_index = pd.concat([site_index, new_site_index], ignore_index=True)
+    channel_index = pd.concat([channel_index, new_channel_index], ignore_index=True)
+
+    cl.sort_file_index(file_index)
+    cl.sort_channel_index(channel_index)
+
+    return file_index, site_index, channel_index
+
+# Store the index tables, replacing the existing ones
+def store_index(index_store, file_index, site_index, channel_index, manifest):
+
+    cl.store_index_table(index_store, cn.FILE_INDEX, file_index)
+    cl.store_site_index(index_store, site_index)
+    cl.store_index_table(index_store, cn.CHANNEL_INDEX, channel_index)
+    cl.store_index_table(index_store, cn.FILE_MANIFEST, manifest)
+
+# Index the designated files and append the resulting rows to the index tables, without reading the existing file and channel rows.
+# Used to keep the index updated as each file is decoded. Appended rows are not sorted, this is done by the merge scripts
+def append_to_index(files):
+
+    index_store = cl.IndexStore()
+    manifest = build_manifest(files)
+
+    if cn.MANIFEST_CONTENT_HASH:
+        manifest[cn.FILE_CONTENT_HASH] = [cl.file_content_hash(file_name) for file_name in files]
+
+    # if there is no index yet, create it with the designated files
+    if cn.FILE_MANIFEST not in index_store:
+        file_index, site_index, channel_index = build_index(index_files(files))
+        cl.sort_file_index(file_index)
+        cl.sort_channel_index(channel_index)
+        store_index(index_store, file_index, site_index, channel_index, manifest)
+        index_store.close()
+        return
+
+    # files that were already indexed, e.g. decoded again, require their previous rows to be removed and the tables are rewritten
+    indexed_files = [file_name for file_name in files
+                     if len(cl.index_select(index_store, cn.FILE_MANIFEST, where={cn.FILENAME_ATTRIBUTE: file_name}, columns=[cn.FILENAME_ATTRIBUTE])) > 0]
+
+    if indexed_files:
+        previous_manifest = index_store[cn.FILE_MANIFEST]
+        manifest = pd.concat([previous_manifest[~previous_manifest[cn.FILENAME_ATTRIBUTE].isin(files)], manifest], ignore_index=True)
+        file_index, site_index, channel_index = update_index(index_store, files, indexed_files)
+        store_index(index_store, file_index, site_index, channel_index, manifest)
+        index_store.close()
+        return
+
+    # else, append the new rows
+    file_index, site_index, channel_index = build_index(index_files(files))
+
+    cl.append_index_table(index_store, cn.FILE_INDEX, file_index)
+    cl.append_index_table(index_store, cn.CHANNEL_INDEX, channel_index)
+    cl.append_index_table(index_store, cn.FILE_MANIFEST, manifest)
+
+    cl.append_site_index(index_store, site_index)
+
+    index_store.close()
+
 def _main():
 
-    # List files on folder
-    files = [f for f in glob.glob(cn.FOLDER_TO_GET_FILES + cn.FILE_TYPE, recursive=False)]
+    # List files on folder, including the subfolder of each sensor
+    files = [f for f in glob.glob(cn.FOLDER_TO_GET_FILES + "**/" + cn.FILE_TYPE, recursive=True)]
     index_length = files.__len__()
 
-    file_index = pd.DataFrame(columns=[cn.FILENAME_ATTRIBUTE,
-                                       H5.INITIAL_FREQUENCY_ATTRIBUTE,
-                                       H5.FINAL_FREQUENCY_ATTRIBUTE,
-                                       H5.START_TIME_COARSE_ATTRIBUTE,
-                                       H5.STOP_TIME_COARSE_ATTRIBUTE])
-
-    # Create a dataframe with file names and reference information
-    file_index[cn.FILENAME_ATTRIBUTE] = files
-    file_index[H5.INITIAL_FREQUENCY_ATTRIBUTE] = [0.0]*index_length
-    file_index[H5.FINAL_FREQUENCY_ATTRIBUTE] = [0.0]*index_length
-    file_index[H5.START_TIME_COARSE_ATTRIBUTE] = [0.0]*index_length
-    file_index[H5.STOP_TIME_COARSE_ATTRIBUTE] = [0.0]*index_length
-
-    site_index = pd.DataFrame(columns=[H5.LATITUDE_MEMBER,
-                                       H5.LONGITUDE_MEMBER,
-                                       H5.CRFS_HOSTNAME])
-
-    channel_index = pd.DataFrame(columns=[cn.CHANNEL_ID,
-                                          cn.FILENAME_ATTRIBUTE,
-                                          cn.GROUPNAME_ATTRIBUTE,
-                                          H5.START_TIME_COARSE_ATTRIBUTE,
-                                          H5.STOP_TIME_COARSE_ATTRIBUTE,
-                                          H5.AVERAGE_CHANNEL_SAMPLE_RATE,
-                                          H5.CHANNEL_EDGE_INITIAL_FREQUENCY,
-                                          cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY,
-                                          H5.CHANNEL_CORE_INITIAL_FREQUENCY,
-                                          H5.CHANNEL_CORE_FINAL_FREQUENCY,
-                                          cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY,
-                                          H5.CHANNEL_EDGE_FINAL_FREQUENCY])
-
-    channel_row = 0
-
-    # Loop through files collecting the required information
-    for row in range(index_length):
-        # Open each file
-        file_name = file_index[cn.FILENAME_ATTRIBUTE][row]
-        cl.log_message("Processing file {}".format(file_name))
-
-        file_object = h5py.File(file_name, 'r')
-        # TODO: Include test if the file follows the standard
-
-        # Get the site coordinates. Work only for single site set of files.
-        if H5.SITE_GEOLOCATION_DATASET in file_object:
-            site_dataset = file_object[H5.SITE_GEOLOCATION_DATASET]
-            site_index.loc[row] = [cl.Normal(), cl.Normal(), "unknown"]
-            site_index.loc[row, H5.LATITUDE_MEMBER].np_set(site_dataset.attrs[H5.LATITUDE_STATISTICS_ATTRIBUTE][0])
-            site_index.loc[row, H5.LONGITUDE_MEMBER].np_set(site_dataset.attrs[H5.LONGITUDE_STATISTICS_ATTRIBUTE][0])
-
-        # Get the unit information from the logbook. Only the first equipment ID is retrived
-        if H5.LOGBOOK_DATASET in file_object:
-            logbook_dataset = file_object[H5.LOGBOOK_DATASET]
-            for log_entry in logbook_dataset:
-                if log_entry[H5.ENTRY_TYPE_MEMBER].decode("ascii") == H5.CRFS_HOSTNAME:
-                    site_index.loc[row, H5.CRFS_HOSTNAME] = log_entry[H5.ENTRY_VALUE_MEMBER].decode("ascii")
-                    break
-
-        # Test if there is a noise group. The noise group contains all traces and thus reference to the time and frequency scope of the file content
-        if H5.NOISE_DATA_GROUP in file_object:
-            # Get a handle on the noise group
-            noise_group = file_object[H5.NOISE_DATA_GROUP]
-
-            # get all sub groups group names within the noise group
-            for sub_group in noise_group:
-
-                # if sub group corresponds to em spectrum group. Noise group also include the level profile group
-                if H5.SPECTROGRAM_CLASS in str(noise_group[sub_group].attrs[H5.CLASS_ATTRIBUTE][0]):
-
-                    # Get the frequency reference data from the frequency axis dataset
-                    frequency_dataset = noise_group[sub_group+'/'+H5.FREQUENCY_DATASET]
-                    file_index.loc[row, H5.INITIAL_FREQUENCY_ATTRIBUTE] = frequency_dataset.attrs[H5.INITIAL_FREQUENCY_ATTRIBUTE][0]
-                    file_index.loc[row, H5.FINAL_FREQUENCY_ATTRIBUTE] = frequency_dataset.attrs[H5.FINAL_FREQUENCY_ATTRIBUTE][0]
-
-                    # Get the time reference data from the timestamp coarse dataset
-                    timestamp_coarse_dataset = noise_group[sub_group+'/'+H5.TIMESTAMP_COARSE_DATASET]
-                    file_index.loc[row, H5.START_TIME_COARSE_ATTRIBUTE] = timestamp_coarse_dataset.attrs[H5.START_TIME_COARSE_ATTRIBUTE][0]
-                    file_index.loc[row, H5.STOP_TIME_COARSE_ATTRIBUTE] = timestamp_coarse_dataset.attrs[H5.STOP_TIME_COARSE_ATTRIBUTE][0]
-
-        if H5.CHANNEL_DATA_GROUP in file_object:
-            # Get a handle on the activity profile group
-            channel_group = file_object[H5.CHANNEL_DATA_GROUP]
-
-            # get all sub groups group names within the noise group
-            for sub_group in channel_group:
-
-                # if sub group corresponds to activity profile group.
-                if H5.ACTIVITY_PROFILE_CLASS in str(channel_group[sub_group].attrs[H5.CLASS_ATTRIBUTE][0]):
-
-                    data = ["",
-                            file_index.loc[row, cn.FILENAME_ATTRIBUTE],
-                            sub_group,
-                            file_index.loc[row, H5.START_TIME_COARSE_ATTRIBUTE],
-                            file_index.loc[row, H5.STOP_TIME_COARSE_ATTRIBUTE],
-                            channel_group[sub_group].attrs[H5.AVERAGE_CHANNEL_SAMPLE_RATE][0],
-                            channel_group[sub_group].attrs[H5.CHANNEL_EDGE_INITIAL_FREQUENCY][0],
-                            channel_group[sub_group].attrs[H5.CHANNEL_EDGE_INITIAL_FREQUENCY][0], # channel edge inner frequency is equal to edge frequency for a single file
-                            channel_group[sub_group].attrs[H5.CHANNEL_CORE_INITIAL_FREQUENCY][0],
-                            channel_group[sub_group].attrs[H5.CHANNEL_CORE_FINAL_FREQUENCY][0],
-                            channel_group[sub_group].attrs[H5.CHANNEL_EDGE_FINAL_FREQUENCY][0], # channel edge inner frequency is equal to edge frequency for a single file
-                            channel_group[sub_group].attrs[H5.CHANNEL_EDGE_FINAL_FREQUENCY][0]]
-
-                    channel_index.loc[channel_row] = data
-                    channel_row += 1
-
-        # If there is no noise group
-        else:
-            # Issue error message and proceed to next file
-            cl.log_message("File {} does not include reference noise data and will be ignored".format(file_name))
-
-    # sort files by timestamp
-    file_index.sort_values(by=[H5.START_TIME_COARSE_ATTRIBUTE], ascending=[True], inplace=True)
-    file_index.reset_index(inplace=True, drop = True)
-    #file_index.to_csv(cn.FOLDER_TO_STORE_FILES+'/'+'file_index_after.csv', index=None, header=True)
-
-    # sort channels by core initial frequency and timestamp
-    channel_index.sort_values(by=[H5.CHANNEL_CORE_INITIAL_FREQUENCY, H5.START_TIME_COARSE_ATTRIBUTE], ascending=[True, True], inplace=True)
-    channel_index.reset_index(inplace=True, drop = True)
-    #channel_index.to_csv(cn.FOLDER_TO_STORE_FILES+'/'+'channel_index_after.csv', index=None, header=True)
+    # Collect the required information from each file and consolidate it into the index tables
+    index_store = cl.IndexStore()
+    manifest = build_manifest(files)
+
+    # if there is a manifest from a previous run, process only the differences
+    if cn.INCREMENTAL_INDEXING and cn.FILE_MANIFEST in index_store:
+        manifest, new_files, changed_files, deleted_files = compare_manifest(manifest, index_store[cn.FILE_MANIFEST])
+        cl.log_message("Found {} new, {} changed and {} deleted files".format(len(new_files), len(changed_files), len(deleted_files)))
+
+        if len(new_files)+len(changed_files)+len(deleted_files) == 0:
+            index_store.close()
+            cl.log_message("Index is up to date")
+            return
+
+        file_index, site_index, channel_index = update_index(index_store, new_files+changed_files, changed_files+deleted_files)
+        index_length = len(new_files)+len(changed_files)
+    # else, index all files
+    else:
+        if cn.MANIFEST_CONTENT_HASH:
+            manifest[cn.FILE_CONTENT_HASH] = [cl.file_content_hash(file_name) for file_name in files]
+
+        # Collect the required information from each file and consolidate it into the index tables
+        file_records = index_files(files)
+        file_index, site_index, channel_index = build_index(file_records)
+        cl.sort_file_index(file_index)
+        cl.sort_channel_index(channel_index)
 
     # store the index tables created
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
-    index_store[cn.FILE_INDEX] = file_index
-    index_store[cn.SITE_INDEX] = site_index
-    index_store[cn.CHANNEL_INDEX] = channel_index
+    store_index(index_store, file_index, site_index, channel_index, manifest)
     index_store.close()
-    
+
     # output message
     cl.log_message("Finish indexing {} files".format(index_length))
 
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# Metrics for the inbox watchdog: counters, gauges and histograms exposed in the Prometheus text format.
+# The metrics can be served on a local HTTP port or appended periodically to a file that is rotated on a regular interval.
+
+import time
+import asyncio
+import logging
+import logging.handlers
+from collections import deque
+
+# metric that only increase, optionally with labels
+class Counter(object):
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = dict()
+
+    def increment(self, amount=1, **labels):
+        label_key = tuple(sorted(labels.items()))
+        self.values[label_key] = self.values.get(label_key, 0)+amount
+
+    def exposition(self, timestamp_text):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} counter".format(self.name)]
+        for label_key, value in self.values.items():
+            lines.append("{}{} {}{}".format(self.name, _label_text(label_key), value, timestamp_text))
+        return lines
+
+# metric with a value that is computed by a function when exposed
+class Gauge(object):
+    def __init__(self, name, description, value_function):
+        self.name = name
+        self.description = description
+        self.value_function = value_function
+
+    def exposition(self, timestamp_text):
+        return ["# HELP {} {}".format(self.name, self.description),
+                "# TYPE {} gauge".format(self.name),
+                "{} {}{}".format(self.name, self.value_function(), timestamp_text)]
+
+# metric that count observations on cumulative buckets
+class Histogram(object):
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for bucket_number, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[bucket_number] += 1
+
+    def exposition(self, timestamp_text):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        for upper_bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            lines.append("{}_bucket{{le=\"{}\"}} {}{}".format(self.name, upper_bound, bucket_count, timestamp_text))
+        lines.append("{}_bucket{{le=\"+Inf\"}} {}{}".format(self.name, self.count, timestamp_text))
+        lines.append("{}_sum {}{}".format(self.name, self.sum, timestamp_text))
+        lines.append("{}_count {}{}".format(self.name, self.count, timestamp_text))
+        return lines
+
+# format the labels of a sample
+def _label_text(label_key):
+    if not label_key:
+        return ""
+    return "{"+",".join("{}=\"{}\"".format(label_name, label_value) for label_name, label_value in label_key)+"}"
+
+# metrics collected by the ingestion engine
+class IngestionMetrics(object):
+    # queue_depth_function and running_function are called on each exposition to get the current queue depth and number of running decoders
+    def __init__(self, queue_depth_function, running_function):
+        self.completion_times = deque()
+
+        self.queue_depth = Gauge("ingestion_queue_depth", "Files waiting for the transfer to finish or on the decode run queue", queue_depth_function)
+        self.running_decoders = Gauge("ingestion_running_decoders", "Decoder process running", running_function)
+        self.files_per_hour = Gauge("ingestion_files_per_hour", "Files decoded over the last hour", self._files_per_hour)
+        self.decode_total = Counter("ingestion_decode_total", "Decoded files by result")
+        self.decoded_bytes = Counter("ingestion_decoded_bytes_total", "Bytes of input files decoded")
+        self.wait_seconds = Histogram("ingestion_wait_seconds", "Time from the first inotify event to the decode start",
+                                      [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600])
+        self.decode_seconds_per_megabyte = Histogram("ingestion_decode_seconds_per_megabyte", "Decode wall time per MB of input file",
+                                                     [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+
+        self.metrics = [self.queue_depth, self.running_decoders, self.files_per_hour, self.decode_total,
+                        self.decoded_bytes, self.wait_seconds, self.decode_seconds_per_megabyte]
+
+    # register the start of a decode, with the time in seconds since the first event on the file
+    def decode_started(self, wait_time):
+        self.wait_seconds.observe(wait_time)
+
+    # register the end of a decode
+    def decode_finished(self, success, file_size, decode_time):
+        self.decode_total.increment(result="success" if success else "failure")
+
+        if success:
+            self.decoded_bytes.increment(file_size)
+            if file_size > 0:
+                self.decode_seconds_per_megabyte.observe(decode_time/(file_size/(1024*1024)))
+            self.completion_times.append(time.monotonic())
+
+    # number of files decoded with success on the last hour
+    def _files_per_hour(self):
+        one_hour_ago = time.monotonic()-3600
+        while self.completion_times and self.completion_times[0] < one_hour_ago:
+            self.completion_times.popleft()
+        return self.completion_times.__len__()
+
+    # metrics in the Prometheus text format. If with_timestamp, each sample includes the current time, as used on the metrics file
+    def exposition(self, with_timestamp=False) -> str:
+        timestamp_text = " {}".format(int(time.time()*1000)) if with_timestamp else ""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.exposition(timestamp_text)
+        return "\n".join(lines)+"\n"
+
+    # answer any HTTP request with the metrics
+    async def _handle_request(self, reader, writer):
+        try:
+            # read and discard the request until the end of the headers
+            while True:
+                request_line = await reader.readline()
+                if request_line in (b"\r\n", b"\n", b""):
+                    break
+
+            body = self.exposition().encode("utf-8")
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         + "Content-Length: {}\r\n".format(len(body)).encode("ascii")
+                         + b"Connection: close\r\n\r\n"
+                         + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    # serve the metrics on a local HTTP port
+    async def serve(self, port, host="127.0.0.1"):
+        return await asyncio.start_server(self._handle_request, host, port)
+
+    # append the metrics to a file every write_period seconds. The file is rotated every rotation_hours, keeping backup_count old files
+    async def write_periodically(self, file_name, write_period, rotation_hours, backup_count):
+        metrics_logger = logging.getLogger("ingestion_metrics")
+        metrics_logger.propagate = False
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.addHandler(logging.handlers.TimedRotatingFileHandler(file_name, when='H', interval=rotation_hours, backupCount=backup_count))
+
+        while True:
+            await asyncio.sleep(write_period)
+            metrics_logger.info(self.exposition(with_timestamp=True))
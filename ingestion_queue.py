@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Persistent record of the files processed by the inbox watchdog.
+# Each file is stored with its current state, such as that the watchdog can resume after a restart without repeating completed work.
+# Uses SQLite in WAL mode, where each state change is committed before the corresponding file operation is considered complete.
+
+import time
+import sqlite3
+
+# file states
+QUEUED = "queued"
+DECODING = "decoding"
+DONE = "done"
+FAILED = "failed"
+
+# states of files that were not finished
+PENDING_STATES = (QUEUED, DECODING)
+
+class IngestionQueue(object):
+    def __init__(self, database_file_name):
+        self.connection = sqlite3.connect(database_file_name, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS ingestion_queue (
+                                       source_file TEXT PRIMARY KEY,
+                                       file_name TEXT NOT NULL,
+                                       state TEXT NOT NULL,
+                                       file_size INTEGER,
+                                       return_code INTEGER,
+                                       attempts INTEGER NOT NULL DEFAULT 0,
+                                       updated REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ingestion_queue_state ON ingestion_queue (state)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ingestion_queue_file_name ON ingestion_queue (file_name)")
+
+    # set the state of a file, creating the record if needed. The number of attempts is incremented each time the file enters the decoding state
+    # and is reset when a finished file is queued again, e.g. when a new file with the same name is placed on the inbox
+    def set_state(self, source_file, file_name, state, file_size=None, return_code=None):
+        self.connection.execute("""INSERT INTO ingestion_queue (source_file, file_name, state, file_size, return_code, attempts, updated)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT(source_file) DO UPDATE SET
+                                       state = excluded.state,
+                                       file_size = COALESCE(excluded.file_size, file_size),
+                                       return_code = excluded.return_code,
+                                       attempts = CASE WHEN excluded.state = ? AND state IN (?, ?) THEN 0 ELSE attempts END + excluded.attempts,
+                                       updated = excluded.updated""",
+                                (source_file, file_name, state, file_size, return_code, 1 if state == DECODING else 0, time.time(), QUEUED, DONE, FAILED))
+
+    # return the state of the file or None if the file is unknown
+    def state(self, source_file):
+        row = self.connection.execute("SELECT state FROM ingestion_queue WHERE source_file = ?", (source_file,)).fetchone()
+        return None if row is None else row[0]
+
+    # return the number of times the file entered the decoding state, 0 if the file is unknown
+    def attempts(self, source_file):
+        row = self.connection.execute("SELECT attempts FROM ingestion_queue WHERE source_file = ?", (source_file,)).fetchone()
+        return 0 if row is None else row[0]
+
+    # return a list of (source_file, file_name) tuples for the files in any of the designated states
+    def files_in_state(self, *states):
+        placeholders = ",".join("?"*len(states))
+        return self.connection.execute("SELECT source_file, file_name FROM ingestion_queue WHERE state IN ({})".format(placeholders), states).fetchall()
+
+    def close(self):
+        self.connection.close()
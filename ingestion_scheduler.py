@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Admission controlled scheduler for the decoder process started by the inbox watchdog.
+# Files waiting for decoding are kept on bounded run queues, one for each shard (e.g. each sensor), and started when there is a free worker and enough memory on the budget.
+# Workers are shared by all shards. When a worker is free, the shard with the fewest running jobs is served first, such as that one busy shard can't starve the others,
+# while capacity not used by idle shards is taken by the ones that have files waiting.
+# Within a shard, the shortest job is started first, with priority increasing with the waiting time such as that large files are not starved.
+
+import os
+import time
+import asyncio
+from datetime import datetime
+
+# information about one file waiting for or under decoding
+class DecodeJob(object):
+    def __init__(self, key, shard, file_size, memory_estimate, coroutine_function, arguments):
+        self.key = key
+        self.shard = shard
+        self.file_size = file_size
+        self.memory_estimate = memory_estimate
+        self.coroutine_function = coroutine_function
+        self.arguments = arguments
+        self.submit_time = time.monotonic()
+
+# scheduler that limits the number of parallel decoder process and the memory they are expected to use.
+# Must be created and used from within the event loop
+class DecodeScheduler(object):
+    # number_of_workers: maximum number of parallel jobs. 0 to use the number of cores
+    # memory_budget: maximum memory in bytes for the running jobs. 0 to disable the memory limit
+    # memory_per_input_byte: factor used to estimate the memory used by the decoder from the input file size
+    # queue_size: maximum number of jobs waiting on the run queue of each shard. Further submissions wait for space
+    # age_weight: bytes discounted from the file size, for the priority computation, for each second of waiting
+    # shard_max_workers: maximum number of parallel jobs for a single shard. 0 to allow a shard to use all workers if the others are idle
+    def __init__(self, number_of_workers=0, memory_budget=0, memory_per_input_byte=1.0, queue_size=64, age_weight=1024*1024, shard_max_workers=0):
+        if number_of_workers < 1:
+            number_of_workers = os.cpu_count()
+
+        self.number_of_workers = number_of_workers
+        self.memory_budget = memory_budget
+        self.memory_per_input_byte = memory_per_input_byte
+        self.queue_size = queue_size
+        self.age_weight = age_weight
+        self.shard_max_workers = shard_max_workers
+        self.memory_in_use = 0
+        self.ready_jobs = dict()
+        self.running_jobs = dict()
+        self.running_per_shard = dict()
+        self.queue_space = dict()
+        self.keys = set()
+
+    # a key is on the scheduler from the submission until the job is finished
+    def __contains__(self, key):
+        return key in self.keys
+
+    # number of jobs running
+    def running_count(self) -> int:
+        return self.running_jobs.__len__()
+
+    # number of jobs waiting on the run queues
+    def queued_count(self) -> int:
+        return sum(shard_jobs.__len__() for shard_jobs in self.ready_jobs.values())
+
+    # number of jobs submitted and not yet started, including the ones waiting for space on the run queue
+    def pending_count(self) -> int:
+        return self.keys.__len__()-self.running_jobs.__len__()
+
+    # place a job on the run queue of the shard, waiting for space if the queue is full. coroutine_function(*arguments) is awaited when the job is started
+    async def submit(self, key, file_size, coroutine_function, *arguments, shard=""):
+        self.keys.add(key)
+
+        if shard not in self.queue_space:
+            self.queue_space[shard] = asyncio.Semaphore(self.queue_size)
+            self.ready_jobs[shard] = []
+            self.running_per_shard[shard] = 0
+        await self.queue_space[shard].acquire()
+
+        memory_estimate = int(file_size*self.memory_per_input_byte)
+        self.ready_jobs[shard].append(DecodeJob(key, shard, file_size, memory_estimate, coroutine_function, arguments))
+        self._dispatch()
+
+    # priority value for the job, the lower the value the sooner the job is started
+    def _priority(self, job, current_time):
+        return job.file_size - self.age_weight*(current_time-job.submit_time)
+
+    # test if the job fits on the memory budget. A job is always admitted if nothing is running, to avoid blocking on files larger than the budget
+    def _admissible(self, job) -> bool:
+        if self.memory_budget <= 0 or self.running_jobs.__len__() == 0:
+            return True
+
+        return self.memory_in_use+job.memory_estimate <= self.memory_budget
+
+    # select the next job to start, from the shard with the fewest running jobs that has an admissible job. Return None if there is none
+    def _next_job(self, current_time):
+        selected_job = None
+        selected_key = None
+
+        for shard, shard_jobs in self.ready_jobs.items():
+            if self.shard_max_workers > 0 and self.running_per_shard[shard] >= self.shard_max_workers:
+                continue
+
+            candidate_jobs = [job for job in shard_jobs if self._admissible(job)]
+            if not candidate_jobs:
+                continue
+
+            job = min(candidate_jobs, key=lambda one_job: self._priority(one_job, current_time))
+            job_key = (self.running_per_shard[shard], self._priority(job, current_time))
+            if selected_key is None or job_key < selected_key:
+                selected_job = job
+                selected_key = job_key
+
+        return selected_job
+
+    # start jobs while there are free workers and admissible jobs on the queues
+    def _dispatch(self):
+        current_time = time.monotonic()
+
+        while self.running_jobs.__len__() < self.number_of_workers:
+            job = self._next_job(current_time)
+            if job is None:
+                break
+
+            self.ready_jobs[job.shard].remove(job)
+            self.queue_space[job.shard].release()
+
+            self.memory_in_use += job.memory_estimate
+            self.running_per_shard[job.shard] += 1
+            job_task = asyncio.get_event_loop().create_task(job.coroutine_function(*job.arguments))
+            self.running_jobs[job_task] = job
+            job_task.add_done_callback(self._job_done)
+
+    # release the resources used by the job and start the next ones
+    def _job_done(self, job_task):
+        job = self.running_jobs.pop(job_task)
+        self.memory_in_use -= job.memory_estimate
+        self.running_per_shard[job.shard] -= 1
+        self.keys.discard(job.key)
+
+        if not job_task.cancelled() and job_task.exception() is not None:
+            print("{}: Job for {} failed: {}".format(datetime.now(), job.key, job_task.exception()))
+
+        self._dispatch()
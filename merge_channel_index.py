@@ -3,8 +3,10 @@
 #%% [markdown]
 # # Data Indexer
 # This script sweeps the file index and consolidate channel information into a channel index
+# Channels are consolidated separately for each site, identified by the equipment ID, with sites processed in parallel
 
 # Import standard libraries
+import numpy as np
 import pandas as pd
 
 # Import specific libraries used by the cortex system
@@ -12,145 +14,338 @@ import h5_spectrum as H5
 import cortex_names as cn
 import cortex_lib as cl
 
+# frequency boundaries of a channel, in the order used by the channel data table
+FREQUENCY_COLUMNS = [H5.CHANNEL_EDGE_INITIAL_FREQUENCY,
+                     cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY,
+                     H5.CHANNEL_CORE_INITIAL_FREQUENCY,
+                     H5.CHANNEL_CORE_FINAL_FREQUENCY,
+                     cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY,
+                     H5.CHANNEL_EDGE_FINAL_FREQUENCY]
+
+CHANNEL_DATA_COLUMNS = [cn.CHANNEL_ID, H5.CRFS_HOSTNAME] + FREQUENCY_COLUMNS
+
+# channel names, composed by the site and the center frequency in kHz rounded to integer
+SITE_CHANNEL_ID = "{}_{:.0f}"
+
+# number of rows evaluated at once when searching for the end of a channel. Doubled while the channel extends beyond it
+SWEEP_WINDOW = 64
+
+# test if the channel core 'd' intersects the core on the index 'i' or the other way around
+def _intersects(channel_core_initial, channel_core_final, core_initial, core_final):
+    i_inside_d = (core_initial <= channel_core_initial) & (channel_core_initial <= core_final)
+    d_inside_i = (channel_core_initial <= core_initial) & (core_initial <= channel_core_final)
+
+    return i_inside_d | d_inside_i
+
+# update the core of a channel with the core of a row merged into it. Core is the intersection, but only contracted while the core remains larger than zero
+def _contract_core(channel_core_initial, channel_core_final, core_initial, core_final):
+    # move core begin to the right if the new core begin is still smaller than the core end
+    if channel_core_initial < core_initial < channel_core_final:
+        channel_core_initial = core_initial
+
+    # move core end to the left if the new core end is still larger than the core begin
+    if channel_core_initial < core_final < channel_core_final:
+        channel_core_final = core_final
+
+    return channel_core_initial, channel_core_final
+
+# merge rows into the channel starting at row 'start', one row at a time, testing if the channel core on the consolidated list 'd' intersect the channel on the index 'i' or the other way around.
+# Core is the intersection, but only contracted while the core remains larger than zero.
+# Used for channels that include rows with invalid or degenerate cores, where the result depends on the order in which the rules are applied.
+# return the first row of the next channel and the consolidated core boundaries
+def _merge_channel_by_row(core_initial: np.ndarray, core_final: np.ndarray, start):
+    channel_core_initial = core_initial[start]
+    channel_core_final = core_final[start]
+
+    row = start + 1
+    while row < len(core_initial):
+        if not _intersects(channel_core_initial, channel_core_final, core_initial[row], core_final[row]):
+            break
+
+        channel_core_initial, channel_core_final = _contract_core(channel_core_initial, channel_core_final, core_initial[row], core_final[row])
+
+        row += 1
+
+    return row, channel_core_initial, channel_core_final
+
+# sweep the core intervals, sorted by core initial frequency, and group the rows that belong to the same channel.
+# Since rows are sorted, a row belong to the current channel while its core begin is not above the running minimum of the core end,
+# the core begin of the channel is the one from its last row and the core end is the running minimum.
+# Channels with invalid or degenerate cores, where the rules for contracting the core do not apply, are merged row by row.
+# return the first row of each channel and the consolidated core boundaries
+def sweep_channels(core_initial: np.ndarray, core_final: np.ndarray):
+    number_of_rows = len(core_initial)
+    regular_core = np.isfinite(core_initial) & np.isfinite(core_final) & (core_initial < core_final)
+
+    channel_start = []
+    channel_core_initial = []
+    channel_core_final = []
+
+    start = 0
+    while start < number_of_rows:
+        # search the end of the channel within a window that grows until the end is found
+        window = SWEEP_WINDOW
+        while True:
+            stop = min(start + window, number_of_rows)
+            running_core_final = np.minimum.accumulate(core_final[start:stop])
+            outside = np.flatnonzero(core_initial[start+1:stop] > running_core_final[:-1])
+
+            if outside.size > 0:
+                end = start + 1 + outside[0]
+                break
+            elif stop == number_of_rows:
+                end = stop
+                break
+
+            window *= 2
+
+        # a core begin equal to the running core end do not contract the channel core, neither do invalid cores
+        length = end - start
+        if regular_core[start:end].all() and (core_initial[start+1:end] < running_core_final[:length-1]).all():
+            core = (core_initial[end-1], running_core_final[length-1])
+        else:
+            end, *core = _merge_channel_by_row(core_initial, core_final, start)
+
+        channel_start.append(start)
+        channel_core_initial.append(core[0])
+        channel_core_final.append(core[1])
+
+        start = end
+
+    return np.array(channel_start, dtype=np.int64), np.array(channel_core_initial, dtype=np.float64), np.array(channel_core_final, dtype=np.float64)
+
+# aggregate the values of each channel, starting at the rows in channel_start, using np.fmin or np.fmax.
+# Rows with missing values do not update the channel but, as in a row by row merge, a missing value on the first row of the channel is kept
+def _aggregate_channels(function, values: np.ndarray, channel_start: np.ndarray) -> np.ndarray:
+    aggregate = function.reduceat(values, channel_start)
+    aggregate[np.isnan(values[channel_start])] = np.nan
+
+    return aggregate
+
+# create channels from the frequencies of channel index rows sorted by core initial frequency.
+# Core is the intersection, edge is the union and inner edge is the intersection of the cores and edges of the rows merged in each channel.
+# Channels are named after the site and the center frequency in kHz rounded to integer.
+# return the channel data and the channel ID assigned to each row
+def _create_channels(frequency: dict, site):
+    channel_start, core_initial, core_final = sweep_channels(frequency[H5.CHANNEL_CORE_INITIAL_FREQUENCY],
+                                                             frequency[H5.CHANNEL_CORE_FINAL_FREQUENCY])
+
+    center_frequency = np.round((core_final + core_initial)/2000)
+    channel_id = np.array([SITE_CHANNEL_ID.format(site, frequency_khz) for frequency_khz in center_frequency], dtype=object)
+
+    channel_data = pd.DataFrame({cn.CHANNEL_ID: channel_id,
+                                 H5.CRFS_HOSTNAME: site,
+                                 H5.CHANNEL_EDGE_INITIAL_FREQUENCY: _aggregate_channels(np.fmin, frequency[H5.CHANNEL_EDGE_INITIAL_FREQUENCY], channel_start),
+                                 cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY: _aggregate_channels(np.fmax, frequency[cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY], channel_start),
+                                 H5.CHANNEL_CORE_INITIAL_FREQUENCY: core_initial,
+                                 H5.CHANNEL_CORE_FINAL_FREQUENCY: core_final,
+                                 cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY: _aggregate_channels(np.fmin, frequency[cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY], channel_start),
+                                 H5.CHANNEL_EDGE_FINAL_FREQUENCY: _aggregate_channels(np.fmax, frequency[H5.CHANNEL_EDGE_FINAL_FREQUENCY], channel_start)},
+                                columns=CHANNEL_DATA_COLUMNS)
+
+    channel_length = np.diff(np.append(channel_start, len(frequency[H5.CHANNEL_CORE_INITIAL_FREQUENCY])))
+
+    return channel_data, np.repeat(channel_id, channel_length)
+
+# consolidate the channel index of a site, sorted by core initial frequency, into the channel data table and link the channel index with the channel data
+def consolidate_channels(channel_index: pd.DataFrame, site) -> pd.DataFrame:
+    if len(channel_index.index) == 0:
+        return pd.DataFrame(columns=CHANNEL_DATA_COLUMNS)
+
+    frequency = {column: channel_index[column].to_numpy(dtype=np.float64) for column in FREQUENCY_COLUMNS}
+
+    channel_data, channel_id = _create_channels(frequency, site)
+    channel_index[cn.CHANNEL_ID] = channel_id
+
+    return channel_data
+
+# locate the channel whose core intersects each of the cores, with a sorted search over the channel cores sorted by core initial frequency.
+# Channel cores do not intersect each other, thus the candidates are the last channel starting at or before the core begin, or else the first channel starting after it.
+# return the channel position for each core or -1 if no channel intersects it
+def match_channels(channel_core_initial: np.ndarray, channel_core_final: np.ndarray, core_initial: np.ndarray, core_final: np.ndarray) -> np.ndarray:
+    number_of_channels = len(channel_core_initial)
+    if number_of_channels == 0:
+        return np.full(len(core_initial), -1, dtype=np.int64)
+
+    before = np.searchsorted(channel_core_initial, core_initial, side='right') - 1
+    after = before + 1
+
+    candidate = np.maximum(before, 0)
+    match_before = (before >= 0) & _intersects(channel_core_initial[candidate], channel_core_final[candidate], core_initial, core_final)
+    candidate = np.minimum(after, number_of_channels-1)
+    match_after = (after < number_of_channels) & _intersects(channel_core_initial[candidate], channel_core_final[candidate], core_initial, core_final)
+
+    return np.where(match_before, before, np.where(match_after, after, -1)).astype(np.int64)
+
+# merge channel index rows of a site not yet linked to a channel into the existing channel data of the site.
+# Rows intersecting an existing channel update its boundaries in place and keep its channel ID, the remaining rows are consolidated into new channels.
+# The channel index is updated with the channel names. return the updated channel data, sorted by core initial frequency
+def merge_new_channels(channel_data: pd.DataFrame, channel_index: pd.DataFrame, site) -> pd.DataFrame:
+    if len(channel_index.index) == 0:
+        return channel_data
+
+    channel_data = channel_data.sort_values(by=[H5.CHANNEL_CORE_INITIAL_FREQUENCY], kind='stable').reset_index(drop=True)
+    data = {column: channel_data[column].to_numpy(dtype=np.float64, copy=True) for column in FREQUENCY_COLUMNS}
+    data_core_initial = data[H5.CHANNEL_CORE_INITIAL_FREQUENCY]
+    data_core_final = data[H5.CHANNEL_CORE_FINAL_FREQUENCY]
+
+    # process rows in the same order used to consolidate the full channel index
+    order = np.lexsort((channel_index[H5.START_TIME_COARSE_ATTRIBUTE].to_numpy(dtype=np.float64),
+                        channel_index[H5.CHANNEL_CORE_INITIAL_FREQUENCY].to_numpy(dtype=np.float64)))
+    frequency = {column: channel_index[column].to_numpy(dtype=np.float64)[order] for column in FREQUENCY_COLUMNS}
+    core_initial = frequency[H5.CHANNEL_CORE_INITIAL_FREQUENCY]
+    core_final = frequency[H5.CHANNEL_CORE_FINAL_FREQUENCY]
+
+    match = match_channels(data_core_initial, data_core_final, core_initial, core_final)
+
+    # contract the channel cores. Since a core may be contracted by a previous row, the match is tested again against the current core
+    for row in np.flatnonzero(match >= 0):
+        channel = match[row]
+        if not _intersects(data_core_initial[channel], data_core_final[channel], core_initial[row], core_final[row]):
+            channel = match_channels(data_core_initial, data_core_final, core_initial[row:row+1], core_final[row:row+1])[0]
+            match[row] = channel
+            if channel < 0:
+                continue
+
+        data_core_initial[channel], data_core_final[channel] = _contract_core(data_core_initial[channel], data_core_final[channel], core_initial[row], core_final[row])
+
+    # edge is the union and inner edge the intersection. Missing values do not update the channel and a missing value on the channel is kept
+    matched = match >= 0
+    for function, column in [(np.fmin, H5.CHANNEL_EDGE_INITIAL_FREQUENCY),
+                             (np.fmax, cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY),
+                             (np.fmin, cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY),
+                             (np.fmax, H5.CHANNEL_EDGE_FINAL_FREQUENCY)]:
+        missing = np.isnan(data[column])
+        function.at(data[column], match[matched], frequency[column][matched])
+        data[column][missing] = np.nan
+
+    for column in FREQUENCY_COLUMNS:
+        channel_data[column] = data[column]
+
+    channel_id = np.empty(len(order), dtype=object)
+    channel_id[order[matched]] = channel_data[cn.CHANNEL_ID].to_numpy()[match[matched]]
+
+    # rows not intersecting any existing channel create new channels
+    if not matched.all():
+        new_channel_data, new_channel_id = _create_channels({column: values[~matched] for column, values in frequency.items()}, site)
+        channel_id[order[~matched]] = new_channel_id
+
+        cl.log_message("Created {} new channels for site {}".format(len(new_channel_data.index), site))
+
+        channel_data = pd.concat([channel_data, new_channel_data], ignore_index=True)
+        channel_data.sort_values(by=[H5.CHANNEL_CORE_INITIAL_FREQUENCY], kind='stable', inplace=True)
+        channel_data.reset_index(drop=True, inplace=True)
+
+    channel_index[cn.CHANNEL_ID] = channel_id
+
+    return channel_data
+
+# consolidate the channels of a site, used by the worker process. return the channel data and the channel ID of each channel index row
+def _consolidate_site(partition):
+    site, channel_index = partition
+
+    channel_data = consolidate_channels(channel_index, site)
+    cl.log_message("Consolidated {} channels for site {}".format(len(channel_data.index), site))
+
+    return channel_data, channel_index[cn.CHANNEL_ID].to_numpy()
+
+# merge the new channel index rows of a site, used by the worker process. return the channel data of the site and the channel ID of each new row
+def _merge_site(partition):
+    site, channel_data, channel_index = partition
+
+    channel_data = merge_new_channels(channel_data, channel_index, site)
+
+    return channel_data, channel_index[cn.CHANNEL_ID].to_numpy()
+
+# split the channel index by site, keeping the row order within each site. return the partitions and the row positions of each one
+def _partition_by_site(channel_index: pd.DataFrame, site_index: pd.DataFrame):
+    channel_site = cl.site_of_rows(channel_index, site_index).to_numpy()
+
+    sites = sorted(set(channel_site))
+    positions = [np.flatnonzero(channel_site == site) for site in sites]
+
+    return sites, positions
+
 def _main():
 
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
+    index_store = cl.IndexStore()
+    site_index = cl.read_site_index(index_store)
+
+    # file rows appended as files are decoded are not sorted. Update the store with the sorted file index, whether channels are merged incrementally or not
     file_index = index_store[cn.FILE_INDEX]
-    site_index = index_store[cn.SITE_INDEX]
+    cl.sort_file_index(file_index)
+    cl.store_index_table(index_store, cn.FILE_INDEX, file_index)
+
+    # if channels were consolidated before, merge only the channel index rows not yet linked to a channel. Channel data without sites is consolidated again
+    channel_data = index_store[cn.CHANNEL_DATA_TABLE] if cn.CHANNEL_DATA_TABLE in index_store else None
+    if cn.INCREMENTAL_CHANNEL_MERGE and channel_data is not None and H5.CRFS_HOSTNAME in channel_data.columns:
+        new_rows = cl.index_coordinates(index_store, cn.CHANNEL_INDEX, where={cn.CHANNEL_ID: ""})
+
+        if len(new_rows) == 0:
+            index_store.close()
+            cl.log_message("Channel data is up to date")
+            return
+
+        cl.log_message("Starting channel merge of {} new channel index entries".format(len(new_rows)))
+
+        channel_index = index_store.select(cn.CHANNEL_INDEX, where=new_rows)
+
+        sites, positions = _partition_by_site(channel_index, site_index)
+
+        partitions = [(site, channel_data[channel_data[H5.CRFS_HOSTNAME] == site], channel_index.iloc[site_positions])
+                      for site, site_positions in zip(sites, positions)]
+        results = cl.map_partitions(_merge_site, partitions)
+
+        channel_id = np.empty(len(channel_index.index), dtype=object)
+        for site_positions, (_, site_channel_id) in zip(positions, results):
+            channel_id[site_positions] = site_channel_id
+
+        # keep the channel data of sites without new rows
+        channel_data = pd.concat([channel_data[~channel_data[H5.CRFS_HOSTNAME].isin(sites)]] + [site_channel_data for site_channel_data, _ in results], ignore_index=True)
+        channel_data.sort_values(by=[H5.CRFS_HOSTNAME, H5.CHANNEL_CORE_INITIAL_FREQUENCY], kind='stable', inplace=True)
+        channel_data.reset_index(drop=True, inplace=True)
+
+        index_store[cn.CHANNEL_DATA_TABLE] = channel_data
+        cl.update_index_column(index_store, cn.CHANNEL_INDEX, new_rows, cn.CHANNEL_ID, channel_id)
+
+        index_store.close()
+
+        cl.log_message("Finish data indexing with {} channels".format(len(channel_data.index)))
+        return
+
     channel_index = index_store[cn.CHANNEL_INDEX]
 
-    # update the store with the sorted file_index
-    index_store[cn.FILE_INDEX]=file_index
-
-    # create new dataframe that will store the consolidated data for the detected channels
-    channel_data = pd.DataFrame(columns=[cn.CHANNEL_ID,
-                                         H5.CHANNEL_EDGE_INITIAL_FREQUENCY,
-                                         cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY,
-                                         H5.CHANNEL_CORE_INITIAL_FREQUENCY,
-                                         H5.CHANNEL_CORE_FINAL_FREQUENCY,
-                                         cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY,
-                                         H5.CHANNEL_EDGE_FINAL_FREQUENCY])
-
-    # initialize the consolidated channel dataframe
-    channel_row = 0
-    input_file_name = channel_index.loc[channel_row, cn.FILENAME_ATTRIBUTE]
-    center_frequency = round((channel_index.loc[channel_row, H5.CHANNEL_CORE_FINAL_FREQUENCY] + channel_index.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY])/2000)
-    cl.log_message("Starting channel {} at {}kHz with file {}".format(channel_row, center_frequency, input_file_name))
-
-    current_channel_id = "Channel {}".format(channel_row)
-    data = [current_channel_id,
-            channel_index.iloc[channel_row, 6], # edge initial frequency
-            channel_index.iloc[channel_row, 7], # edge inner initial frequency
-            channel_index.iloc[channel_row, 8], # core initial frequency
-            channel_index.iloc[channel_row, 9], # core final frequency
-            channel_index.iloc[channel_row, 10], # edge inner final frequency
-            channel_index.iloc[channel_row, 11]] # edge final frequency
-
-    channel_data.loc[channel_row] = data
-    channel_index.loc[channel_row, cn.CHANNEL_ID] = current_channel_id
-
-    # loop through all channel information from different files
-    index_length = len(channel_index.index)
-    for row in range(1, index_length, 1):
-        # test if channel core on the consolidated list 'd' (channel_Data at channel_row) intersect the channel on the index file 'i' (channel_Index at row) or the other way around
-        index_core_first = channel_index.loc[row, H5.CHANNEL_CORE_INITIAL_FREQUENCY] <= channel_data.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY]
-        data_core_first = channel_data.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY] <= channel_index.loc[row, H5.CHANNEL_CORE_INITIAL_FREQUENCY]
-        i_inside_d = index_core_first and (channel_data.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY] <= channel_index.loc[row, H5.CHANNEL_CORE_FINAL_FREQUENCY])
-        d_inside_i = data_core_first and (channel_index.loc[row, H5.CHANNEL_CORE_INITIAL_FREQUENCY] <= channel_data.loc[channel_row, H5.CHANNEL_CORE_FINAL_FREQUENCY])
-
-        # if they do intercept, merge the channel information
-        if i_inside_d or d_inside_i:
-            # link channel index with the channel data
-            channel_index.loc[row, cn.CHANNEL_ID] = current_channel_id
-
-            # update the channel data boundaries. Core is the intersection, edge is the union
-            # if stored edge begin is larger than the new edge
-            if channel_data.iloc[channel_row, 1] > channel_index.iloc[row, 6]:
-                # update edge begin. (move edge to the left, expand)
-                channel_data.iloc[channel_row, 1] = channel_index.iloc[row, 6]
-
-            # if stored edge begin is smaller than the new edge
-            if channel_data.iloc[channel_row, 2] < channel_index.iloc[row, 7]:
-                # update edge begin. (moved edge to the right, contract) There is no risk of crossing of edges since the core is in between, a condition guaranteed by the detection algorithm
-                channel_data.iloc[channel_row, 2] = channel_index.iloc[row, 7]
-
-            # if stored core begin is lower than the new core
-            if channel_data.iloc[channel_row, 3] < channel_index.iloc[row, 8]:
-                # if new core begin still smaller than the core end. Necessary to avoid core equal or smaler than zero
-                if channel_index.iloc[row, 8] < channel_data.iloc[channel_row, 4]:
-                    # update core begin (move core to the right, contract)
-                    channel_data.iloc[channel_row, 3] = channel_index.iloc[row, 8]
-
-            # if stored core end is higher than the new core
-            if channel_data.iloc[channel_row, 4] > channel_index.iloc[row, 9]:
-                # if new core end still larger than the core begin
-                if channel_index.iloc[row, 9] > channel_data.iloc[channel_row, 3]:
-                    # update core end (move core to the left, contract)
-                    channel_data.iloc[channel_row, 4] = channel_index.iloc[row, 9]
-
-            # if stored edge end is larger than the new edge
-            if channel_data.iloc[channel_row, 5] > channel_index.iloc[row, 10]:
-                # update edge end (move edge to the left, contract)
-                channel_data.iloc[channel_row, 5] = channel_index.iloc[row, 10]
-
-            # if stored edge end is smaller than the new edge
-            if channel_data.iloc[channel_row, 6] < channel_index.iloc[row, 11]:
-                # update edge end (move edge to the right, expand)
-                channel_data.iloc[channel_row, 6] = channel_index.iloc[row, 11]
-
-            input_file_name = channel_index.loc[row, cn.FILENAME_ATTRIBUTE]
-            center_frequency = round((channel_data.loc[channel_row, H5.CHANNEL_CORE_FINAL_FREQUENCY] + channel_data.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY])/2000)
-            cl.log_message("   | Merged channel {} at {}kHz with file {}".format(row, center_frequency, input_file_name))
-
-        # if they do not intercept
-        else:
-            # a new channel needs to be assigned
-            channel_row += 1
-            current_channel_id = "Channel {}".format(channel_row)
-            data = [current_channel_id,
-                    channel_index.iloc[row, 6],
-                    channel_index.iloc[row, 7],
-                    channel_index.iloc[row, 8],
-                    channel_index.iloc[row, 9],
-                    channel_index.iloc[row, 10],
-                    channel_index.iloc[row, 11]]
-
-            channel_data.loc[channel_row] = data
-            channel_index.loc[row, cn.CHANNEL_ID] = current_channel_id
-
-            input_file_name = channel_index.loc[row, cn.FILENAME_ATTRIBUTE]
-            center_frequency = round((channel_data.loc[channel_row, H5.CHANNEL_CORE_FINAL_FREQUENCY] + channel_data.loc[channel_row, H5.CHANNEL_CORE_INITIAL_FREQUENCY])/2000)
-            cl.log_message("Starting channel {} at {}kHz with file {}".format(channel_row, center_frequency, input_file_name))
-
-    # loop through channel data and reasign names to the new center frequency in kHz rounded to integer
-    cl.log_message("Starting channel renaming")
-    
-    index_length = len(channel_data.index)
-    for row in range(0, index_length, 1):
-        center_frequency = round((channel_data.loc[row, H5.CHANNEL_CORE_FINAL_FREQUENCY] + channel_data.loc[row, H5.CHANNEL_CORE_INITIAL_FREQUENCY])/2000)
-
-        current_channel_id = "{:.0f}".format(center_frequency)
-
-        channel_index.replace(to_replace=channel_data.loc[row, cn.CHANNEL_ID], value=current_channel_id, inplace=True)
-        channel_data.loc[row, cn.CHANNEL_ID] = current_channel_id
-        cl.log_message("Channel {} renamed at {}kHz".format(row, center_frequency))
-        """
-        print("{} - {}: {:.0f}, {:.0f}, {:.0f}, {:.0f}".format(row,
-                                                               channel_data.loc[row, cn.CHANNEL_ID],
-                                                               channel_data.loc[row, H5.CHANNEL_EDGE_INITIAL_FREQUENCY],
-                                                               channel_data.loc[row, H5.CHANNEL_CORE_INITIAL_FREQUENCY],
-                                                               channel_data.loc[row, H5.CHANNEL_CORE_FINAL_FREQUENCY],
-                                                               channel_data.loc[row, H5.CHANNEL_EDGE_FINAL_FREQUENCY]))
-        """
+    # rows appended as files are decoded are not sorted
+    cl.sort_channel_index(channel_index)
+
+    cl.log_message("Starting channel consolidation of {} channel index entries".format(len(channel_index.index)))
+
+    # consolidate the channels of each site on a separate worker process
+    sites, positions = _partition_by_site(channel_index, site_index)
+
+    partitions = [(site, channel_index.iloc[site_positions].reset_index(drop=True)) for site, site_positions in zip(sites, positions)]
+    results = cl.map_partitions(_consolidate_site, partitions)
+
+    channel_id = np.empty(len(channel_index.index), dtype=object)
+    for site_positions, (_, site_channel_id) in zip(positions, results):
+        channel_id[site_positions] = site_channel_id
+    channel_index[cn.CHANNEL_ID] = channel_id
+
+    if results:
+        channel_data = pd.concat([site_channel_data for site_channel_data, _ in results], ignore_index=True)
+    else:
+        channel_data = pd.DataFrame(columns=CHANNEL_DATA_COLUMNS)
+
+    cl.log_message("Consolidated {} channels from {} sites".format(len(channel_data.index), len(sites)))
+
     #channel_data.to_csv(cn.FOLDER_TO_STORE_FILES+'/'+'channel_data.csv', index=None, header=True)
 
     index_store[cn.CHANNEL_DATA_TABLE] = channel_data
-    index_store[cn.CHANNEL_INDEX] = channel_index
+    cl.store_index_table(index_store, cn.CHANNEL_INDEX, channel_index)
 
     index_store.close()
 
     cl.log_message("Finish data indexing")
-    #print("site_index: "+str(site_index.shape))
     #print("file_index: "+str(file_index.shape))
 
 if __name__ == '__main__':
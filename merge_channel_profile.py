@@ -2,6 +2,7 @@
 
 # # Channel profile merger
 # This script sweeps the detected channels and merge the level profile.
+# By default source files are processed one at a time, reading the profiles of all channels in the file at once
 
 # Import standard libraries
 import pandas as pd
@@ -12,99 +13,133 @@ import h5_spectrum as H5
 import cortex_names as cn
 import cortex_lib as cl
 
-def _main():
+# add the level profile that corresponds to the activity profile group of a channel to the accumulated profile.
+# return the number of traces on the profile
+def add_level_profile(profile_accumulator: cl.ProfileAccumulator, input_file_object, input_group_name):
+    input_group_name = input_group_name.replace(H5.ACTIVITY_PROFILE_DATA_GROUP, H5.LEVEL_PROFILE_DATA_GROUP)
 
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
+    # Get a handle on the group
+    input_profile_group = input_file_object[H5.CHANNEL_DATA_GROUP+"/"+input_group_name]
 
-    channel_data = index_store[cn.CHANNEL_DATA_TABLE]
-    index_length = len(channel_data.index)-1
+    # recover the dataset reference handle
+    profile_dataset = input_profile_group[H5.LEVEL_PROFILE_DATASET]
+    profile_attributes = cl.read_attributes(profile_dataset)
+    # Todo: test if level units are compatible
+
+    number_of_traces = profile_attributes[H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE]
+    if number_of_traces > 0:
+        profile_accumulator.add(profile_dataset[:],
+                                input_profile_group[H5.FREQUENCY_DATASET][:],
+                                input_profile_group[H5.LEVEL_DATASET][:],
+                                level_step=profile_attributes.get(H5.LEVEL_STEP_ATTRIBUTE),
+                                number_of_traces=number_of_traces)
+
+    return number_of_traces
+
+# store the dataframe with the merged level profile and the number of traces as attribute of the group where the dataframe is stored
+def store_channel_profile(data_writer: cl.DataWriter, channel_id, profile_accumulator: cl.ProfileAccumulator):
+    output_group_name = H5.CHANNEL_DATA_GROUP+"/"+H5.LEVEL_PROFILE_DATA_GROUP+channel_id
+    data_writer.write_dataframe(output_group_name, profile_accumulator.profile())
+    data_writer.set_attributes(output_group_name, {H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE: profile_accumulator.number_of_traces})
+
+# merge the profiles one channel at a time, reading the groups of each channel from all files where it was found.
+# Source files are kept open on a cache, such as that files are not opened again for each channel
+def merge_by_channel(index_store: pd.HDFStore, channel_data: pd.DataFrame, file_validator: cl.FileValidator, data_writer: cl.DataWriter):
 
-    channel_index = index_store[cn.CHANNEL_INDEX]
-    channel_index.set_index(cn.CHANNEL_ID, inplace=True)
+    file_cache = cl.OpenFileCache()
 
     # Loop through channels grouped collecting the required information
-    for row in range(index_length):
+    for row in range(len(channel_data.index)):
 
-        # create empty dataframe to store the resulting profile
-        profile_array_result = pd.DataFrame()
-        number_of_traces = 0
+        # create the accumulator for the resulting profile
+        profile_accumulator = cl.ProfileAccumulator()
 
         # Get the channel ID
         channel_id = channel_data.loc[row, cn.CHANNEL_ID]
 
-        # Select files that contain the designated channel
-        files_with_channel = channel_index[channel_index.index == channel_id]
+        # Select files that contain the designated channel. Only the matching rows are read from the index
+        files_with_channel = cl.index_select(index_store, cn.CHANNEL_INDEX, where={cn.CHANNEL_ID: channel_id}, columns=[cn.FILENAME_ATTRIBUTE, cn.GROUPNAME_ATTRIBUTE])
 
-        # Get the number of files to be processed
-        channel_index_length = len(files_with_channel.index)
+        # loop through files that are marked with the indicated channel
+        for input_file_name, input_group_name in files_with_channel.itertuples(index=False):
 
-        # initialize bolean variable responsible to signaling the existance of at least one profile
-        shall_remove_channel_reference = True
+            # skip files that do not follow the standard
+            if not file_validator.is_valid(input_file_name):
+                continue
 
-        # initialize variable to store the total number of profiles and avoid scope limitations due to conditional initialization
-        number_of_traces_sum = 0
+            if add_level_profile(profile_accumulator, file_cache.get(input_file_name), input_group_name) == 0:
+                cl.log_message("File {} has no profile data".format(input_file_name))
+                #TODO: Delete from index
 
-        # loop through files that are marked with the indicated channel
-        for channel_row in range(channel_index_length):
+            cl.log_message("Processed {}/{}. Profile shape: {}".format(input_file_name, input_group_name, str(profile_accumulator.shape)))
 
-            # get the file and group for the channel data
-            input_file_name = files_with_channel.iloc[channel_row, 0]
+        # If no profile is really stored for the channel. May happen if channel was created due to database reference
+        if profile_accumulator.number_of_traces == 0:
+            cl.log_message("No profile for channel {}".format(channel_id))
+        else:
+            store_channel_profile(data_writer, channel_id, profile_accumulator)
 
-            input_group_name = files_with_channel.iloc[channel_row, 1]
-            input_group_name = input_group_name.replace(H5.ACTIVITY_PROFILE_DATA_GROUP, H5.LEVEL_PROFILE_DATA_GROUP)
+    file_cache.close()
 
-            # open the file
-            input_file_object = h5py.File(input_file_name, 'r')
-            # TODO: Include test if the file follows the standard
+# merge the profiles one source file at a time, opening each file once and adding the profile of all its channels to the result of each channel
+def merge_by_file(index_store: pd.HDFStore, channel_data: pd.DataFrame, file_validator: cl.FileValidator, data_writer: cl.DataWriter):
 
-            # Get a handle on the group
-            input_profile_group = input_file_object[H5.CHANNEL_DATA_GROUP+"/"+input_group_name]
+    channel_ids = channel_data[cn.CHANNEL_ID].tolist()
 
-            # recover the dataset reference handle
-            profile_dataset = input_profile_group[H5.LEVEL_PROFILE_DATASET]
-            # Todo: test if level units are compatible
+    # accumulator for the resulting profile of each channel
+    profile_accumulator = {channel_id: cl.ProfileAccumulator() for channel_id in channel_ids}
 
-            # update the counter for the number of traces on the profile
-            number_of_traces = profile_dataset.attrs[H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE][0]
-            if number_of_traces > 0:
-                number_of_traces_sum += number_of_traces
+    # Select the groups of all channels on the channel data
+    channel_groups = index_store.select(cn.CHANNEL_INDEX, columns=[cn.CHANNEL_ID, cn.FILENAME_ATTRIBUTE, cn.GROUPNAME_ATTRIBUTE])
+    channel_groups = channel_groups[channel_groups[cn.CHANNEL_ID].isin(channel_ids)]
 
-                # Get the level profile
-                profile_array_new = pd.DataFrame(profile_dataset[:])
-                profile_array_new.columns = input_profile_group[H5.FREQUENCY_DATASET][:]
-                profile_array_new.index = input_profile_group[H5.LEVEL_DATASET][:]
+    # loop through files, reading the groups of all channels found on each file
+    for input_file_name, file_channel_groups in channel_groups.groupby(cn.FILENAME_ATTRIBUTE, sort=True):
 
-                # Merge the new profile into the result
-                profile_array_result = profile_array_result.add(profile_array_new, fill_value=0.0)
+        # skip files that do not follow the standard
+        if not file_validator.is_valid(input_file_name):
+            continue
 
-                profile_array_result.fillna(0, inplace=True)
+        with h5py.File(input_file_name, 'r') as input_file_object:
+            for channel_id, input_group_name in file_channel_groups[[cn.CHANNEL_ID, cn.GROUPNAME_ATTRIBUTE]].itertuples(index=False):
 
-                shall_remove_channel_reference = False
-            else:
-                cl.log_message("File {} has no profile data".format(input_file_name))
-                #TODO: Delete from index
+                if add_level_profile(profile_accumulator[channel_id], input_file_object, input_group_name) == 0:
+                    cl.log_message("File {} has no profile data".format(input_file_name))
+                    #TODO: Delete from index
 
-            cl.log_message("Processed {}/{}. Profile shape: {}".format(input_file_name, input_group_name, str(profile_array_result.shape)))
+        cl.log_message("Processed {} with {} channels".format(input_file_name, len(file_channel_groups.index)))
 
+    for channel_id in channel_ids:
         # If no profile is really stored for the channel. May happen if channel was created due to database reference
-        if shall_remove_channel_reference:
-            cl.log_message("No profile for channel {}/{}".format(input_file_name, input_group_name))
-        
+        if profile_accumulator[channel_id].number_of_traces == 0:
+            cl.log_message("No profile for channel {}".format(channel_id))
         else:
-            # store the dataframe with the merged level profile
-            output_file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME
-            index_store = pd.HDFStore(output_file_name)
-            output_group_name = H5.CHANNEL_DATA_GROUP+"/"+H5.LEVEL_PROFILE_DATA_GROUP+channel_id 
-            index_store[output_group_name] = profile_array_result
-            index_store.close()
-            
-            # store the attributes to the group where the dataframe is stored
-            output_file_object = h5py.File(output_file_name)
-            output_file_object[output_group_name].attrs[H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE] = number_of_traces_sum
-            output_file_object.close()
+            store_channel_profile(data_writer, channel_id, profile_accumulator[channel_id])
+
+def _main():
+
+    index_store = cl.IndexStore(mode='r')
+
+    channel_data = index_store[cn.CHANNEL_DATA_TABLE]
+    index_length = len(channel_data.index)
+
+    # validator used to skip files that do not follow the standard
+    file_validator = cl.FileValidator()
+
+    # writer for the merged profiles
+    data_writer = cl.DataWriter()
+
+    if cn.PROFILE_MERGE_FILE_MAJOR:
+        merge_by_file(index_store, channel_data, file_validator, data_writer)
+    else:
+        merge_by_channel(index_store, channel_data, file_validator, data_writer)
+
+    data_writer.close()
+    index_store.close()
+    file_validator.close()
 
     # output message
-    cl.log_message("Finish indexing {} files".format(index_length))
+    cl.log_message("Finish merging the profile of {} channels".format(index_length))
 
 if __name__ == '__main__':
     _main()
@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 
 # # Merge spectrograms for each trace and compute the mean value for each spectrogram
+# Spectrograms are merged as a stream, with traces written to the data file one chunk at a time, such as that memory use does not grow with the channel history
 
 # Import standard libraries
-import pandas as pd
+import os
+import shutil
+import tempfile
+import heapq
+from multiprocessing import Pool
 import numpy as np
-import h5py
 
 # Import specific libraries used by the cortex system
 import h5_spectrum as H5
@@ -14,25 +18,409 @@ import cortex_lib as cl
 
 # TODO: This could be improved by testing the similarity before merging and so allow for separation of co channel emissions
 
+# get the spectrogram group of a channel on a source file
+def get_spectrogram_group(input_file_object, input_group_name):
+    input_group_name = input_group_name.replace(H5.ACTIVITY_PROFILE_DATA_GROUP, H5.EM_SPECTRUM_DATA_GROUP)
+    return input_file_object[H5.CHANNEL_DATA_GROUP+"/"+input_group_name]
+
+# get the frequency axis of the spectrogram group, rounded to the frequency resolution, and a mask selecting the bins within the cut frequencies
+def cut_frequency_axis(input_group, initial_cut_frequency, final_cut_frequency):
+    frequency_axis = np.array(input_group[H5.FREQUENCY_DATASET][:]/cn.FREQUENCY_RESOLUTION)
+    frequency_axis = cn.FREQUENCY_RESOLUTION*frequency_axis.round(0)
+
+    # select only the needed frequencies
+    frequency_mask = np.ones(frequency_axis.shape, dtype=bool)
+    if frequency_axis[0] < initial_cut_frequency:
+        frequency_mask &= frequency_axis > initial_cut_frequency
+    if frequency_axis[-1] > final_cut_frequency:
+        frequency_mask &= frequency_axis < final_cut_frequency
+
+    return frequency_axis, frequency_mask
+
+# use a slice instead of the list of columns if they are contiguous, such as that blocks are copied without fancy indexing
+def _as_slice(columns):
+    if columns.size > 0 and np.all(np.diff(columns) == 1):
+        return slice(int(columns[0]), int(columns[-1])+1)
+    return columns
+
+# Map the frequency bins of the spectrogram groups of the source files into the channel frequency grid, the union of the frequencies of all groups.
+# The column offsets of each (file name, group name) are computed once, such as that traces are scattered into the output without matching frequencies
+class FrequencyGridMapper:
+
+    def __init__(self, initial_cut_frequency, final_cut_frequency):
+        self.initial_cut_frequency = initial_cut_frequency
+        self.final_cut_frequency = final_cut_frequency
+        self.frequency_axis = np.empty(0)
+        self.source_columns = {}
+        self.grid_columns = {}
+        self.source_frequency = {}
+
+    # add the frequency axis of the spectrogram group to the grid
+    def add(self, key, input_group):
+        frequency_axis, frequency_mask = cut_frequency_axis(input_group, self.initial_cut_frequency, self.final_cut_frequency)
+        self.source_columns[key] = np.flatnonzero(frequency_mask)
+        self.source_frequency[key] = frequency_axis[frequency_mask]
+
+    # build the channel frequency grid and the column offsets of all groups added
+    def build(self):
+        if self.source_frequency:
+            self.frequency_axis = np.unique(np.concatenate(list(self.source_frequency.values())))
+
+        for key, frequency_axis in self.source_frequency.items():
+            self.grid_columns[key] = _as_slice(np.searchsorted(self.frequency_axis, frequency_axis))
+            self.source_columns[key] = _as_slice(self.source_columns[key])
+        self.source_frequency.clear()
+
+    # scatter the traces read from the group into the output block, with the same number of rows. Missing frequency bins are set to np.NaN
+    def scatter(self, key, traces, output_block):
+        output_block.fill(np.nan)
+        output_block[:, self.grid_columns[key]] = traces[:, self.source_columns[key]]
+
+# Cursor over the traces of the spectrogram group of a source file, in time order, used for the time ordered merge of the groups of a channel.
+# Time is given as an integer number of nanoseconds, such as that traces are compared without rounding.
+# Only the time of the first trace is kept until the cursor is loaded, such as that only the groups being merged hold their time axis in memory
+class SpectrogramCursor:
+
+    def __init__(self, key, input_group):
+        self.key = key
+        self.trace_time = None
+        self.trace_order = None
+        self.position = 0
+
+        trace_time = self._read_time(input_group)
+        self.number_of_traces = trace_time.size
+        self.first_time = int(trace_time.min()) if trace_time.size > 0 else None
+
+    @staticmethod
+    def _read_time(input_group):
+        timestamp_coarse = input_group[H5.TIMESTAMP_COARSE_DATASET][:].astype(np.int64)
+        timestamp_fine = input_group[H5.TIMESTAMP_FINE_DATASET][:].astype(np.int64)
+        return timestamp_coarse*int(cn.NANOSECONDS_IN_SECOND) + timestamp_fine
+
+    # time of the next trace to be read
+    def next_time(self):
+        return self.first_time if self.trace_time is None else int(self.trace_time[self.position])
+
+    def is_finished(self):
+        return self.position >= self.number_of_traces
+
+    # read the next traces in time order, up to the designated time and number of traces. Return the traces and their time
+    def read(self, input_group, maximum_time, maximum_number_of_traces):
+
+        # sort the traces on the first read. Traces are usually stored in time order and can be read as slices
+        if self.trace_time is None:
+            trace_time = self._read_time(input_group)
+            self.trace_order = np.argsort(trace_time, kind='stable')
+            self.trace_time = trace_time[self.trace_order]
+            if np.array_equal(self.trace_order, np.arange(self.number_of_traces)):
+                self.trace_order = None
+
+        first_position = self.position
+        last_position = min(int(np.searchsorted(self.trace_time, maximum_time, side='right')), first_position+maximum_number_of_traces)
+        self.position = last_position
+
+        spectrogram_dataset = input_group[H5.SPECTROGRAM_DATASET]
+        if self.trace_order is None:
+            traces = spectrogram_dataset[first_position:last_position]
+        else:
+            # traces are read in the order stored on the file and then sorted
+            trace_position = self.trace_order[first_position:last_position]
+            stored_position = np.sort(trace_position)
+            traces = spectrogram_dataset[stored_position][np.searchsorted(stored_position, trace_position)]
+
+        trace_time = self.trace_time[first_position:last_position]
+
+        # release the time axis once all traces are read
+        if self.is_finished():
+            self.trace_time = None
+            self.trace_order = None
+
+        return traces, trace_time
+
+# Build the overview pyramid of a merged spectrogram, with levels of decreasing resolution used to plot the spectrogram without reading all traces.
+# Each level combines blocks of SPECTROGRAM_PYRAMID_TIME_FACTOR traces and SPECTROGRAM_PYRAMID_FREQUENCY_FACTOR bins of the previous level, storing the maximum and mean level.
+# Traces are added in chunks as they are merged and each level keeps the traces of the incomplete block until it is completed or the pyramid is closed
+class SpectrogramPyramid:
+
+    def __init__(self, data_writer: cl.DataWriter, group_name, frequency_axis, number_of_traces):
+        self.levels = []
+
+        # number of original bins combined on each bin, used to compute the frequency of the bin as the mean frequency
+        bin_width = np.ones(frequency_axis.shape)
+
+        while number_of_traces > cn.SPECTROGRAM_PYRAMID_MINIMUM_TRACES:
+            number_of_traces = -(-number_of_traces // cn.SPECTROGRAM_PYRAMID_TIME_FACTOR)
+
+            bin_start = np.arange(0, frequency_axis.size, cn.SPECTROGRAM_PYRAMID_FREQUENCY_FACTOR)
+            frequency_axis = np.add.reduceat(frequency_axis*bin_width, bin_start) / np.add.reduceat(bin_width, bin_start)
+            bin_width = np.add.reduceat(bin_width, bin_start)
+
+            level_name = group_name+"/"+cn.SPECTROGRAM_OVERVIEW_GROUP+"/"+str(len(self.levels)+1)
+            data_writer.write_array(level_name+"/"+H5.FREQUENCY_DATASET, frequency_axis)
+
+            self.levels.append({'bin start': bin_start,
+                                'pending': None,
+                                cn.OVERVIEW_MAXIMUM_DATASET: data_writer.create_extendable_array(level_name+"/"+cn.OVERVIEW_MAXIMUM_DATASET, row_shape=(frequency_axis.size,), dtype=np.float32, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS),
+                                cn.OVERVIEW_MEAN_DATASET: data_writer.create_extendable_array(level_name+"/"+cn.OVERVIEW_MEAN_DATASET, row_shape=(frequency_axis.size,), dtype=np.float32, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS),
+                                cn.TIMESTAMP_DATASET: data_writer.create_extendable_array(level_name+"/"+cn.TIMESTAMP_DATASET, dtype=np.float64, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS)})
+
+    # add a chunk of traces of the merged spectrogram. Missing levels are given as np.NaN
+    def add(self, spectrogram_chunk, timestamp_chunk):
+        if self.levels:
+            level_is_missing = np.isnan(spectrogram_chunk)
+            self._add(0, spectrogram_chunk, np.where(level_is_missing, 0.0, spectrogram_chunk), (~level_is_missing).astype(np.int64), timestamp_chunk)
+
+    # store the incomplete blocks on all levels
+    def close(self):
+        for level_number, level in enumerate(self.levels):
+            if level['pending'] is not None:
+                level_maximum, level_sum, level_count, timestamp = level['pending']
+                level['pending'] = None
+                self._store(level_number,
+                            np.fmax.reduce(level_maximum, axis=0, keepdims=True),
+                            level_sum.sum(axis=0, keepdims=True),
+                            level_count.sum(axis=0, keepdims=True),
+                            timestamp[:1])
+
+    # add traces to the level, given by their maximum, sum and number of values on each bin and their time
+    def _add(self, level_number, level_maximum, level_sum, level_count, timestamp):
+        level = self.levels[level_number]
+
+        # combine the frequency bins
+        values = [np.fmax.reduceat(level_maximum, level['bin start'], axis=1),
+                  np.add.reduceat(level_sum, level['bin start'], axis=1),
+                  np.add.reduceat(level_count, level['bin start'], axis=1),
+                  timestamp]
+
+        # join the traces of the incomplete block
+        if level['pending'] is not None:
+            values = [np.concatenate((pending_value, value)) for pending_value, value in zip(level['pending'], values)]
+
+        # combine complete blocks of traces. The time of the block is the time of the first trace
+        number_of_blocks = len(values[3]) // cn.SPECTROGRAM_PYRAMID_TIME_FACTOR
+        block_end = number_of_blocks*cn.SPECTROGRAM_PYRAMID_TIME_FACTOR
+        level['pending'] = [value[block_end:] for value in values] if block_end < len(values[3]) else None
+
+        if number_of_blocks > 0:
+            block_shape = (number_of_blocks, cn.SPECTROGRAM_PYRAMID_TIME_FACTOR)
+            self._store(level_number,
+                        np.fmax.reduce(values[0][:block_end].reshape(block_shape+values[0].shape[1:]), axis=1),
+                        values[1][:block_end].reshape(block_shape+values[1].shape[1:]).sum(axis=1),
+                        values[2][:block_end].reshape(block_shape+values[2].shape[1:]).sum(axis=1),
+                        values[3][:block_end:cn.SPECTROGRAM_PYRAMID_TIME_FACTOR])
+
+    # store the combined traces on the level and add them to the next level
+    def _store(self, level_number, level_maximum, level_sum, level_count, timestamp):
+        level = self.levels[level_number]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            level_mean = level_sum / level_count
+
+        level[cn.OVERVIEW_MAXIMUM_DATASET].append(level_maximum.astype(np.float32))
+        level[cn.OVERVIEW_MEAN_DATASET].append(level_mean.astype(np.float32))
+        level[cn.TIMESTAMP_DATASET].append(timestamp)
+
+        if level_number+1 < len(self.levels):
+            self._add(level_number+1, level_maximum, level_sum, level_count, timestamp)
+
+# path of the merged spectrogram group and of the mean level array of the channel on the data file
+def spectrogram_group_name(channel_id):
+    return H5.CHANNEL_DATA_GROUP+"/"+H5.EM_SPECTRUM_DATA_GROUP+channel_id
+
+def mean_level_name(channel_id):
+    return H5.CHANNEL_DATA_GROUP+"/"+cn.CHANNEL_MEAN_LEVEL_CATALOG+"/"+channel_id
+
+# remove the merged spectrogram and the mean level of the channel, such as that data from a previous run is not kept for a channel without spectrogram
+def remove_channel(channel_id, data_writer: cl.DataWriter):
+    data_writer.remove(spectrogram_group_name(channel_id))
+    data_writer.remove(mean_level_name(channel_id))
+
+# merge the spectrograms of the channel, given as a list of (file name, group name) tuples, into the file held by the data writer.
+# The first pass reads the frequency axis and the time of the first trace of each file to build the channel frequency axis.
+# The second pass merges the traces of all files in time order into the output, one chunk at a time, while adding up the level of each frequency bin.
+# The third pass fills the missing bins with the mean level of the bin.
+# Return False if there is no spectrogram for the channel, in which case existing data for the channel is removed
+def merge_channel(channel_id, initial_cut_frequency, final_cut_frequency, files_with_channel, file_cache: cl.OpenFileCache, data_writer: cl.DataWriter):
+
+    # build the channel frequency axis with all frequencies found within the cut frequencies and the cursors used to merge the groups in time order
+    grid_mapper = FrequencyGridMapper(initial_cut_frequency, final_cut_frequency)
+    spectrogram_cursors = []
+    for input_file_name, input_group_name in files_with_channel:
+        input_group = get_spectrogram_group(file_cache.get(input_file_name), input_group_name)
+        grid_mapper.add((input_file_name, input_group_name), input_group)
+        spectrogram_cursors.append(SpectrogramCursor((input_file_name, input_group_name), input_group))
+    grid_mapper.build()
+
+    channel_frequency_axis = grid_mapper.frequency_axis
+    number_of_bins = channel_frequency_axis.size
+    if number_of_bins == 0:
+        cl.log_message("No spectrogram for channel {}".format(channel_id))
+        remove_channel(channel_id, data_writer)
+        return False
+
+    # create the datasets for the merged spectrogram, replacing existing data for the channel
+    output_group_name = spectrogram_group_name(channel_id)
+    data_writer.remove(output_group_name)
+    spectrogram_result = data_writer.create_extendable_array(output_group_name+"/"+H5.SPECTROGRAM_DATASET, row_shape=(number_of_bins,), dtype=np.float32, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS)
+    timestamp_result = data_writer.create_extendable_array(output_group_name+"/"+cn.TIMESTAMP_DATASET, dtype=np.float64, chunk_rows=cn.SPECTROGRAM_CHUNK_ROWS)
+    data_writer.write_array(output_group_name+"/"+H5.FREQUENCY_DATASET, channel_frequency_axis)
+
+    # sum and number of values on each frequency bin, used to compute the mean level
+    bin_level_sum = np.zeros(number_of_bins)
+    bin_level_count = np.zeros(number_of_bins, dtype=np.int64)
+
+    # block where the traces of each chunk are aligned to the channel frequency axis
+    spectrogram_block = np.empty((cn.SPECTROGRAM_CHUNK_ROWS, number_of_bins), dtype=np.float32)
+
+    # merge the groups in time order, using a heap with the time of the next trace of each group.
+    # Traces are read from the group with the earliest trace up to the time of the next trace on the other groups, such as that groups that don't overlap are read in chunks
+    merge_heap = [(spectrogram_cursor.first_time, cursor_number) for cursor_number, spectrogram_cursor in enumerate(spectrogram_cursors) if not spectrogram_cursor.is_finished()]
+    heapq.heapify(merge_heap)
+    last_time = -1
+    number_of_merged_groups = 0
+    while merge_heap:
+        _, cursor_number = heapq.heappop(merge_heap)
+        spectrogram_cursor = spectrogram_cursors[cursor_number]
+        input_file_name, input_group_name = spectrogram_cursor.key
+
+        maximum_time = merge_heap[0][0] if merge_heap else np.iinfo(np.int64).max
+        traces, trace_time = spectrogram_cursor.read(get_spectrogram_group(file_cache.get(input_file_name), input_group_name), maximum_time, cn.SPECTROGRAM_CHUNK_ROWS)
+
+        # Missing frequency bins are left as np.NaN
+        spectrogram_new = spectrogram_block[:len(trace_time)]
+        grid_mapper.scatter(spectrogram_cursor.key, traces, spectrogram_new)
+
+        # drop duplicated traces, with the same time of a trace already merged, such as that the time axis is strictly increasing
+        trace_is_new = np.diff(trace_time, prepend=last_time) > 0
+        if not trace_is_new.all():
+            spectrogram_new = spectrogram_new[trace_is_new]
+            trace_time = trace_time[trace_is_new]
+
+        if trace_time.size > 0:
+            last_time = trace_time[-1]
+
+            # the time is given by the timestamp, in seconds
+            timestamp_new = trace_time // int(cn.NANOSECONDS_IN_SECOND) + (trace_time % int(cn.NANOSECONDS_IN_SECOND)) / cn.NANOSECONDS_IN_SECOND
+
+            spectrogram_result.append(spectrogram_new)
+            timestamp_result.append(timestamp_new)
+
+            bin_level_sum += np.nansum(spectrogram_new, axis=0)
+            bin_level_count += np.count_nonzero(~np.isnan(spectrogram_new), axis=0)
+
+        if spectrogram_cursor.is_finished():
+            number_of_merged_groups += 1
+            cl.log_message("Processed {}/{}. Spectrogram shape: {}".format(number_of_merged_groups, len(files_with_channel), str(spectrogram_result.shape)))
+        else:
+            heapq.heappush(merge_heap, (spectrogram_cursor.next_time(), cursor_number))
+
+    # Compute the mean level for all traces on the channel, for each frequency bin. Bins without values are left as np.NaN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bin_mean_level = bin_level_sum / bin_level_count
+    mean_level_data = np.append([channel_frequency_axis], [bin_mean_level], axis=0)
+
+    # fill NaN values resulting from incorrect channel splicing with the average channel level over each bin.
+    # The time range of each chunk is collected on the same pass, to be used for time range queries, and the overview pyramid is built from the filled chunks
+    spectrogram_pyramid = SpectrogramPyramid(data_writer, output_group_name, channel_frequency_axis, spectrogram_result.nrows)
+    chunk_rows = spectrogram_result.chunkshape[0]
+    chunk_time_range = []
+    for first_trace in range(0, spectrogram_result.nrows, chunk_rows):
+        last_trace = min(first_trace+chunk_rows, spectrogram_result.nrows)
+
+        timestamp_chunk = timestamp_result[first_trace:last_trace]
+        chunk_time_range.append([timestamp_chunk.min(), timestamp_chunk.max()])
+
+        spectrogram_chunk = spectrogram_result[first_trace:last_trace]
+        missing_level = np.isnan(spectrogram_chunk)
+        if missing_level.any():
+            spectrogram_chunk[missing_level] = np.broadcast_to(bin_mean_level, spectrogram_chunk.shape)[missing_level]
+            spectrogram_result[first_trace:last_trace] = spectrogram_chunk
+
+        spectrogram_pyramid.add(spectrogram_chunk, timestamp_chunk)
+
+    spectrogram_pyramid.close()
+    data_writer.write_array(output_group_name+"/"+cn.TIMESTAMP_CHUNK_RANGE_DATASET, np.array(chunk_time_range, dtype='float64').reshape(-1, 2))
+
+    cl.log_message("PROCESSED CHANNEL: {}".format(channel_id))
+
+    # store the mean level on the channel catalog
+    data_writer.write_array(mean_level_name(channel_id), mean_level_data)
+
+    return True
+
+# worker process function. Merge the channel into a scratch file, that is later copied into the data file by the process that owns it
+def merge_channel_to_file(channel_task):
+    channel_id, initial_cut_frequency, final_cut_frequency, files_with_channel, scratch_file_name = channel_task
+
+    file_cache = cl.OpenFileCache()
+    scratch_writer = cl.DataWriter(scratch_file_name)
+
+    is_merged = merge_channel(channel_id, initial_cut_frequency, final_cut_frequency, files_with_channel, file_cache, scratch_writer)
+
+    scratch_writer.close()
+    file_cache.close()
+
+    return channel_id, scratch_file_name, is_merged
+
+# merge the channels one after another, writing directly into the data file
+def merge_serially(channels):
+
+    # source files are kept open between the passes over each channel
+    file_cache = cl.OpenFileCache()
+
+    # writer for the merged spectrograms
+    data_writer = cl.DataWriter()
+
+    for channel in channels:
+        merge_channel(*channel, file_cache, data_writer)
+
+    file_cache.close()
+    data_writer.close()
+
+# merge the channels on a pool of worker process. Workers load, cut and align the spectrograms into scratch files
+# and this process, the only one holding the data file open, copies each channel into it as the workers finish
+def merge_in_parallel(channels, number_of_workers):
+
+    scratch_folder = tempfile.mkdtemp(dir=cn.FOLDER_TO_STORE_FILES)
+    channel_tasks = [channel+(scratch_folder+"/{}.h5".format(row),) for row, channel in enumerate(channels)]
+
+    # the scratch folder is removed and the buffered data written even if the merge is interrupted
+    try:
+        # workers are started before the data file is opened, such as that they don't inherit its handle
+        with Pool(processes=number_of_workers) as worker_pool:
+
+            # writer for the merged spectrograms
+            data_writer = cl.DataWriter()
+
+            try:
+                for channel_id, scratch_file_name, is_merged in worker_pool.imap_unordered(merge_channel_to_file, channel_tasks):
+                    if is_merged:
+                        data_writer.copy_from(scratch_file_name, spectrogram_group_name(channel_id))
+                        data_writer.copy_from(scratch_file_name, mean_level_name(channel_id))
+                    else:
+                        remove_channel(channel_id, data_writer)
+                    os.remove(scratch_file_name)
+
+                    cl.log_message("Stored channel {}".format(channel_id))
+            finally:
+                data_writer.close()
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+
 def _main():
 
-    file_index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
+    file_index_store = cl.IndexStore(mode='r')
 
     channel_data = file_index_store[cn.CHANNEL_DATA_TABLE]
-    index_length = len(channel_data.index)-1
+    index_length = len(channel_data.index)
 
-    channel_index = file_index_store[cn.CHANNEL_INDEX]
-    channel_index.set_index(cn.CHANNEL_ID, inplace=True)
-
-    #channel_data_mean_level = pd.DataFrame()
-    #channel_data_frequency = pd.DataFrame()
+    # validator used to skip files that do not follow the standard
+    file_validator = cl.FileValidator()
 
     # Loop through channels grouped collecting the required information
+    channels = []
     for row in range(index_length):
 
-        # create empty dataframe to store the resulting profile
-        spectrogram_result = pd.DataFrame()
-
         # Get the channel ID
         channel_id = channel_data.loc[row, cn.CHANNEL_ID]
 
@@ -40,114 +428,29 @@ def _main():
         initial_cut_frequency = channel_data.loc[row, cn.CHANNEL_INNER_EDGE_INITIAL_FREQUENCY]
         final_cut_frequency = channel_data.loc[row, cn.CHANNEL_INNER_EDGE_FINAL_FREQUENCY]
 
-        # Select files that contain the designated channel
-        files_with_channel = channel_index[channel_index.index == channel_id]
-
-        # Get the number of files to be processed
-        channel_index_length = len(files_with_channel.index)
-
-        # loop through files that are marked with the indicated channel
-        for channel_row in range(channel_index_length):
-
-            # get the file and group for the channel data
-            input_file_name = files_with_channel.iloc[channel_row, 0]
-
-            input_group_name = files_with_channel.iloc[channel_row, 1]
-            input_group_name = input_group_name.replace(H5.ACTIVITY_PROFILE_DATA_GROUP, H5.EM_SPECTRUM_DATA_GROUP)
-
-            # open the file
-            input_file_object = h5py.File(input_file_name, 'r')
-            # TODO: Include test if the file follows the standard
-
-            # Get a handle on the group
-            input_group = input_file_object[H5.CHANNEL_DATA_GROUP+"/"+input_group_name]
-
-            # recover the dataset reference handle
-            spectrogram_dataset = input_group[H5.SPECTROGRAM_DATASET]
-
-            # Get the spectrogram into a new dataset
-            spectrogram_new = pd.DataFrame(spectrogram_dataset[:])
-
-            # set the dataset columns as frequency 
-            frequency_axis = np.array(input_group[H5.FREQUENCY_DATASET][:]/cn.FREQUENCY_RESOLUTION)
-            frequency_axis = cn.FREQUENCY_RESOLUTION*frequency_axis.round(0)
-            spectrogram_new.columns = frequency_axis
-
-            # set the dataset index as timestamp
-            timestamp_coarse = input_group[H5.TIMESTAMP_COARSE_DATASET][:]
-            timestamp_fine = input_group[H5.TIMESTAMP_FINE_DATASET][:] / cn.NANOSECONDS_IN_SECOND
-            spectrogram_new.index = timestamp_coarse + timestamp_fine
-
-            # build a reduced frequency axis containing only the needed frequencies
-            axis_has_been_cut = False
-            if frequency_axis[0] < initial_cut_frequency:
-                frequency_axis = frequency_axis[frequency_axis > initial_cut_frequency]
-                axis_has_been_cut = True
-            if frequency_axis[-1] > final_cut_frequency:
-                frequency_axis = frequency_axis[frequency_axis < final_cut_frequency]
-                axis_has_been_cut = True
-
-            # if the frequency axis has been reduced
-            if axis_has_been_cut:
-                # cut the spectrogram dataset using the reduced frequency axis
-                spectrogram_new = spectrogram_new.filter(items=frequency_axis)
-
-            # Merge the new profile into the result
-            # Missing frequency bins are left as np.NaN
-            spectrogram_result = spectrogram_result.append(spectrogram_new)
-
-            cl.log_message("Processed {}/{}. Spectrogram shape: {}".format(channel_row+1, channel_index_length, str(spectrogram_result.shape)))
-
-        # Compute the mean level for all traces on the channel, for each frequency bin
-        bin_mean_level = spectrogram_result.mean(axis='rows')
-        mean_level_data = bin_mean_level.index.to_numpy(dtype='float64')
-        mean_level_data = np.append([mean_level_data], [bin_mean_level.to_numpy(dtype='float64')], axis=0)
-
-        # fill NaN values resulting from incorrect channel splicing with the average channel level over each bin
-        spectrogram_result.fillna(value=bin_mean_level, inplace=True)
-
-        #bin_mean_level = pd.DataFrame(bin_mean_level, columns=[channel_id])
-        #bin_frequency = pd.DataFrame(bin_mean_level.index, columns=[channel_id])
-        #bin_mean_level.reset_index(inplace=True, drop=True)
-
-        # Store mean level on a channel catalog dataframe using the channel ID as index
-        #channel_data_mean_level = channel_data_mean_level.join(bin_mean_level, how='outer')
-        #channel_data_frequency = channel_data_frequency.join(bin_frequency, how='outer')
-
-        cl.log_message("PROCESSED CHANNEL: {}".format(channel_id))
-
-        # store the dataframe with the merged spectrogram
-        output_file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME
-        file_data_store = pd.HDFStore(output_file_name)
-        output_group_name = H5.CHANNEL_DATA_GROUP+"/"+H5.EM_SPECTRUM_DATA_GROUP+channel_id
-        file_data_store[output_group_name] = spectrogram_result
-        file_data_store.close()
-
-        # reopen file with h5Py method
-        file_data_store = h5py.File(output_file_name)
-
-        # Test if the datagroup exist and create it if not
-        output_group_store = file_data_store[H5.CHANNEL_DATA_GROUP]
-        if cn.CHANNEL_MEAN_LEVEL_CATALOG in output_group_store:
-            output_group_store = output_group_store[cn.CHANNEL_MEAN_LEVEL_CATALOG]
-            
-            # test if channel_id already exist and delete it in so. 
-            if channel_id in output_group_store:
-                del output_group_store[channel_id]
-            
-            # store the channel data
-            output_group_store.create_dataset(channel_id, data=mean_level_data)
-        else:
-            output_group_store.create_group(cn.CHANNEL_MEAN_LEVEL_CATALOG)
-            output_group_name = H5.CHANNEL_DATA_GROUP+"/"+cn.CHANNEL_MEAN_LEVEL_CATALOG
-            file_data_store[output_group_name].create_dataset(channel_id, data=mean_level_data)
+        # Select files that contain the designated channel. Only the matching rows are read from the index
+        files_with_channel = cl.index_select(file_index_store, cn.CHANNEL_INDEX, where={cn.CHANNEL_ID: channel_id}, columns=[cn.FILENAME_ATTRIBUTE, cn.GROUPNAME_ATTRIBUTE])
+
+        # skip files that do not follow the standard
+        files_with_channel = [(input_file_name, input_group_name) for input_file_name, input_group_name in files_with_channel.itertuples(index=False)
+                              if file_validator.is_valid(input_file_name)]
+
+        channels.append((channel_id, initial_cut_frequency, final_cut_frequency, files_with_channel))
+
+    file_index_store.close()
+    file_validator.close()
 
-        file_data_store.close()
+    number_of_workers = cn.SPECTROGRAM_MERGE_WORKERS
+    if number_of_workers < 1:
+        number_of_workers = os.cpu_count()
 
-        #cl.table_dataframe(spectrogram_result)
+    # do not spawn more process than channels to process
+    number_of_workers = min(number_of_workers, len(channels))
 
-    #cl.table_dataframe(channel_data_mean_level)
-    #cl.plot_dataframe(channel_data_mean_level.reset_index())
+    if number_of_workers > 1:
+        merge_in_parallel(channels, number_of_workers)
+    else:
+        merge_serially(channels)
 
     # output message
     cl.log_message("Finish indexing {} channels".format(index_length))
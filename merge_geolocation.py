@@ -3,8 +3,10 @@
 #%% [markdown]
 # # Data Indexer
 # This script sweeps the file index and consolidate site information into data tables
+# Sites are identified by the equipment ID and processed in parallel, resulting in one row for each site
 
 # Import standard libraries
+import numpy as np
 import pandas as pd
 
 # Import specific libraries used by the cortex system
@@ -12,50 +14,69 @@ import h5_spectrum as H5
 import cortex_names as cn
 import cortex_lib as cl
 
-def _main():
+# merge the site information from the files of a single site, used by the worker process. return the row for the site data table
+def merge_site(partition):
+    site, site_index, start_time, stop_time = partition
 
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
-    file_index = index_store[cn.FILE_INDEX]
-    site_index = index_store[cn.SITE_INDEX]
+    # only files with geolocation information are merged
+    site_index = site_index[site_index[H5.LATITUDE_MEMBER].map(lambda statistics: isinstance(statistics, cl.Normal))].reset_index(drop=True)
 
-    # TODO: Improve to handle multiple sites
-    # merge site information into a single site
+    if len(site_index.index) == 0:
+        cl.log_message("No geolocation information for site {}".format(site))
+        return [site, np.NaN, np.NaN, start_time, stop_time]
+
+    # merge site information from all files into a single site
     index_length = len(site_index.index)-1
     for row in range(index_length, 0, -1):
         # TODO: Test if distance between average of the two sets are within the variance before adding. If not, more sites should be created
-        # TODO: Test if the equipment ID matches and consolidate information only for the same equipment or better, process equipment information separatly
         site_index.loc[row-1, H5.LATITUDE_MEMBER].add_set(site_index.loc[row, H5.LATITUDE_MEMBER])
         site_index.loc[row-1, H5.LONGITUDE_MEMBER].add_set(site_index.loc[row, H5.LONGITUDE_MEMBER])
         # site_index.loc[row-1, H5.LATITUDE_MEMBER].print("site row {}: ".format(row-1))
         # site_index.loc[row-1, H5.LONGITUDE_MEMBER].print("site row {}: ".format(row-1))
-        site_index.drop(row, inplace=True)
 
-    # create a data table that will be used for plotting
-    site_data = pd.DataFrame(columns=[H5.CRFS_HOSTNAME,
+    # TODO: Add variance to allow ellipse plotting of the site
+    return [site,
+            site_index.loc[0, H5.LATITUDE_MEMBER].mean_value,
+            site_index.loc[0, H5.LONGITUDE_MEMBER].mean_value,
+            start_time,
+            stop_time]
+
+def _main():
+
+    index_store = cl.IndexStore()
+    file_index = index_store[cn.FILE_INDEX]
+    site_index = cl.read_site_index(index_store)
+
+    # time span of the files from each site
+    file_site = cl.site_of_rows(file_index, site_index)
+    site_start_time = file_index[H5.START_TIME_COARSE_ATTRIBUTE].groupby(file_site).min()
+    site_stop_time = file_index[H5.START_TIME_COARSE_ATTRIBUTE].groupby(file_site).max()
+
+    # merge the information of each site, identified by the equipment ID, on a separate worker process
+    sites = sorted(set(site_index[H5.CRFS_HOSTNAME]))
+    partitions = [(site,
+                   site_index[site_index[H5.CRFS_HOSTNAME] == site],
+                   site_start_time.get(site, np.NaN),
+                   site_stop_time.get(site, np.NaN)) for site in sites]
+
+    # create a data table that will be used for plotting, with one row for each site
+    site_data = pd.DataFrame(cl.map_partitions(merge_site, partitions),
+                             columns=[H5.CRFS_HOSTNAME,
                                       H5.LATITUDE_MEMBER,
                                       H5.LONGITUDE_MEMBER,
                                       H5.START_TIME_COARSE_ATTRIBUTE,
                                       H5.STOP_TIME_COARSE_ATTRIBUTE])
 
-    # store the site data on the table
-    # TODO: Add variance to allow ellipse plotting of the site
-    site_data.loc[0, H5.CRFS_HOSTNAME] = site_index.loc[0, H5.CRFS_HOSTNAME]
-    site_data.loc[0, H5.LATITUDE_MEMBER] = site_index.loc[0, H5.LATITUDE_MEMBER].mean_value
-    site_data.loc[0, H5.LONGITUDE_MEMBER] = site_index.loc[0, H5.LONGITUDE_MEMBER].mean_value
-    site_data.loc[0, H5.START_TIME_COARSE_ATTRIBUTE] = file_index.loc[0, H5.START_TIME_COARSE_ATTRIBUTE]
-    site_data.loc[0, H5.STOP_TIME_COARSE_ATTRIBUTE] = file_index.loc[len(file_index.index)-1, H5.START_TIME_COARSE_ATTRIBUTE]
-
     # store the table on the index file
     index_store[cn.SITE_DATA_TABLE] = site_data
 
-    output_file_name = cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME
-    file_data_store = pd.HDFStore(output_file_name)
-    file_data_store[cn.SITE_DATA_TABLE] = site_data
-    file_data_store.close()
+    data_writer = cl.DataWriter()
+    data_writer.write_dataframe(cn.SITE_DATA_TABLE, site_data)
+    data_writer.close()
     
     index_store.close()
 
-    cl.log_message("Finish site data processing")
+    cl.log_message("Finish site data processing for {} sites".format(len(site_data.index)))
     #print("site_index: "+str(site_index.shape))
 
 if __name__ == '__main__':
@@ -5,8 +5,6 @@
 # - Read files on designated folder
 
 # Import standard libraries
-import pandas as pd
-
 import h5py
 
 # Import specific libraries used by the cortex system
@@ -16,21 +14,25 @@ import cortex_lib as cl
 
 def _main():
 
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.INDEX_FILENAME)
+    index_store = cl.IndexStore(mode='r')
     file_index = index_store[cn.FILE_INDEX]
-    index_length = len(file_index.index)-1
+    index_store.close()
+    index_length = len(file_index.index)
+
+    # validator used to skip files that do not follow the standard
+    file_validator = cl.FileValidator()
 
-    # create empty dataframe to store the resulting profile
-    profile_array_result = pd.DataFrame()
-    number_of_traces = 0
+    # create the accumulator for the resulting profile
+    profile_accumulator = cl.ProfileAccumulator()
 
     # Loop through files collecting the required information
-    for row in range(index_length):
-        # Open each file
-        file_name = file_index[cn.FILENAME_ATTRIBUTE][row]
+    for file_name in file_index[cn.FILENAME_ATTRIBUTE]:
+
+        if not file_validator.is_valid(file_name):
+            continue
 
+        # Open each file
         file_object = h5py.File(file_name, 'r')
-        # TODO: Include test if the file follows the standard
 
         # Test if there is a noise group. The noise group contains all traces and thus reference to the time and frequency scope of the file content
         if H5.NOISE_DATA_GROUP in file_object:
@@ -45,25 +47,26 @@ def _main():
 
                     # recover the dataset reference handle
                     profile_dataset = noise_group[sub_group+'/'+H5.LEVEL_PROFILE_DATASET]
+                    profile_attributes = cl.read_attributes(profile_dataset)
                     # Todo: test if level units are compatible
 
-                    # update the counter for the number of traces on the profile
-                    number_of_traces += profile_dataset.attrs[H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE][0]
+                    # Merge the new profile into the result
+                    profile_accumulator.add(profile_dataset[:],
+                                            noise_group[sub_group+'/'+H5.FREQUENCY_DATASET][:],
+                                            noise_group[sub_group+'/'+H5.LEVEL_DATASET][:],
+                                            level_step=profile_attributes.get(H5.LEVEL_STEP_ATTRIBUTE),
+                                            number_of_traces=profile_attributes[H5.NUMBER_OF_PROFILE_TRACES_ATTRIBUTE])
 
-                    # Get the level profile
-                    profile_array_new = pd.DataFrame(profile_dataset[:])
-                    profile_array_new.columns = noise_group[sub_group+'/'+H5.FREQUENCY_DATASET][:]
-                    profile_array_new.index = noise_group[sub_group+'/'+H5.LEVEL_DATASET][:]
+                    cl.log_message("File {} processed. Profile shape: {}".format(file_name, str(profile_accumulator.shape)))
 
-                    # Merge the new profile into the result
-                    profile_array_result = profile_array_result.add(profile_array_new, fill_value=0)
+        file_object.close()
 
-                    cl.log_message("File {} processed. Profile shape: {}".format(file_name, str(profile_array_result.shape)))
+    file_validator.close()
 
-    # store the index tables created
-    index_store = pd.HDFStore(cn.FOLDER_TO_STORE_FILES+'/'+cn.DATA_FILENAME)
-    index_store[H5.NOISE_DATA_GROUP+"/"+H5.LEVEL_PROFILE_DATASET] = profile_array_result
-    index_store.close()
+    # store the merged noise profile
+    data_writer = cl.DataWriter()
+    data_writer.write_dataframe(H5.NOISE_DATA_GROUP+"/"+H5.LEVEL_PROFILE_DATASET, profile_accumulator.profile())
+    data_writer.close()
 
     # output message
     cl.log_message("Finish indexing {} files".format(index_length))